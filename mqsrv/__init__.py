@@ -1,3 +0,0 @@
-import os
-os.environ['GREEN_BACKEND'] = 'gevent'
-from greenthread.monkey import monkey_patch; monkey_patch()
\ No newline at end of file
@@ -0,0 +1,446 @@
+"""
+asyncio client speaking the same wire format as mqsrv.client, built on
+aio-pika instead of greenthreads, so it does not monkey patch the process.
+
+    pip install aio-pika
+"""
+import asyncio
+import time
+from loguru import logger
+from kombu import uuid
+from kombu.compression import decompress
+from kombu.serialization import loads, prepare_accept_content
+
+try:
+    import aio_pika
+except ImportError:
+    aio_pika = None
+
+from .rpc_utils import ACCEPT_CONTENT, serialize, rpc_encode_req, rpc_decode_rep, rpc_encode_batch_req, rpc_decode_batch_rep, rpc_is_batch, rpc_decode_stream_rep, rpc_encode_credit
+from .base import get_connection
+from .compression import get_compression
+from .contract import RPC_EXCHANGE, EVT_EXCHANGE, EXC_TRACEBACK_HEADER, STREAM_HEADER, CREDIT_QUEUE_HEADER, DEADLINE_HEADER, METHOD_HEADER, EVENT_TYPE_HEADER, SENT_AT_HEADER, STATS_RPC
+from .deadline import make_deadline
+from .metrics import Metrics
+
+BATCH_LABEL = '<batch>'
+
+class AsyncPublisher:
+    def __init__(self, client, routing_key, serializer=None):
+        self.client = client
+        self.routing_key = routing_key
+        self.serializer = serializer
+
+    async def publish(self, evt_type, evt_data):
+        await self.client.publish(self.routing_key, evt_type, evt_data, serializer=self.serializer)
+
+    async def __call__(self, evt_type, evt_data):
+        await self.publish(evt_type, evt_data)
+
+    async def publish_many(self, events):
+        await self.client.publish_many(self.routing_key, events, serializer=self.serializer)
+
+class _AsyncMethod:
+    def __init__(self, client, routing_key, method, serializer=None):
+        self.client = client
+        self.routing_key = routing_key
+        self.method = method
+        self.serializer = serializer
+
+    async def __call__(self, *args, timeout=None, **kws):
+        req_id, fut = await self.client._send_request(self.routing_key, self.method, args, kws, serializer=self.serializer, timeout=timeout)
+        return await self.client._wait_reply(req_id, fut, timeout)
+
+    async def call_async(self, *args, timeout=None, **kws):
+        req_id, fut = await self.client._send_request(self.routing_key, self.method, args, kws, serializer=self.serializer, timeout=timeout)
+        return fut
+
+    async def stream(self, *args, timeout=None, window=16, **kws):
+        return await self.client._open_stream(self.routing_key, self.method, args, kws, timeout, window, serializer=self.serializer)
+
+class AsyncRpcStream:
+    """
+    async iterator over the items of a generator rpc, see mqsrv.client.RpcStream
+    """
+    def __init__(self, client, routing_key, req_id, window, timeout=None):
+        self.client = client
+        self.routing_key = routing_key
+        self.req_id = req_id
+        self.window = window
+        self.timeout = timeout
+
+        self.chunks = asyncio.Queue()
+        self.credit_queue = None
+        self.pending = {}
+        self.seq = 0
+        self.consumed = 0
+        self.done = False
+        self.cancelled = False
+
+    def feed(self, payload):
+        self.chunks.put_nowait(payload)
+
+    async def on_reply(self, credit_queue, payload):
+        self.credit_queue = credit_queue or self.credit_queue
+        if not self.cancelled:
+            self.feed(payload)
+            return
+
+        # closed before the server was known
+        self.client.streams.pop(self.req_id, None)
+        if self.credit_queue and not rpc_decode_stream_rep(payload)[3]:
+            await self.client._send_credit(self.req_id, -1, self.credit_queue)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.done:
+            raise StopAsyncIteration
+
+        while self.seq not in self.pending:
+            try:
+                payload = await asyncio.wait_for(self.chunks.get(), self.timeout)
+            except asyncio.TimeoutError:
+                await self.aclose()
+                raise
+
+            seq, error, result, end = rpc_decode_stream_rep(payload)
+            self.pending[seq] = (error, result, end)
+
+        error, result, end = self.pending.pop(self.seq)
+        self.seq += 1
+
+        if end:
+            self._finish()
+            if error:
+                et, ev, tb = error
+                raise ev.with_traceback(tb)
+            raise StopAsyncIteration
+
+        self.consumed += 1
+        if self.consumed >= max(1, self.window // 2):
+            await self.client._send_credit(self.req_id, self.consumed, self.credit_queue)
+            self.consumed = 0
+        return result
+
+    def _finish(self):
+        self.done = True
+        self.client.streams.pop(self.req_id, None)
+
+    async def aclose(self):
+        if self.done:
+            return
+        if self.credit_queue is None:
+            self.done = self.cancelled = True
+            return
+        self._finish()
+        await self.client._send_credit(self.req_id, -1, self.credit_queue)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+class _AsyncBatchMethod:
+    def __init__(self, batch, method):
+        self.batch = batch
+        self.method = method
+
+    def __call__(self, *args, **kws):
+        return self.batch.add(self.method, *args, **kws)
+
+class AsyncBatch:
+    def __init__(self, client, routing_key, serializer=None):
+        self.client = client
+        self.routing_key = routing_key
+        self.serializer = serializer
+        self.entries = []
+
+    def add(self, meth, *args, **kws):
+        self.entries.append((meth, args, kws))
+        return len(self.entries) - 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getattr__(self, meth):
+        return _AsyncBatchMethod(self, meth)
+
+    async def call(self, timeout=None):
+        return await self.client.call_many(self.routing_key, self.entries, timeout=timeout, serializer=self.serializer)
+
+    async def call_async(self):
+        return await self.client.call_many_async(self.routing_key, self.entries, serializer=self.serializer)
+
+class AsyncCaller:
+    def __init__(self, client, routing_key, serializer=None):
+        self.client = client
+        self.routing_key = routing_key
+        self.serializer = serializer
+
+    def __getattr__(self, meth):
+        return _AsyncMethod(self.client, self.routing_key, meth, serializer=self.serializer)
+
+    def batch(self):
+        return AsyncBatch(self.client, self.routing_key, serializer=self.serializer)
+
+class AsyncMessageQueueClient:
+    def __init__(
+            self,
+            url,
+            rpc_exchange=RPC_EXCHANGE,
+            event_exchange=EVT_EXCHANGE,
+            serializer=None,
+            compression=None,
+            exc_traceback=False):
+
+        if aio_pika is None:
+            raise ImportError("AsyncMessageQueueClient requires aio-pika")
+
+        self.url = url
+        self.rpc_exchange_name = rpc_exchange
+        self.event_exchange_name = event_exchange
+        self.serializer = serializer
+        self.compression = get_compression(compression)
+        self.exc_traceback = exc_traceback
+        self.accept = prepare_accept_content(ACCEPT_CONTENT)
+
+        self.req_futures = {}
+        self.streams = {}
+
+        self.metrics = Metrics()
+        self.metrics.add_gauge('rpc_inflight', lambda: len(self.req_futures))
+        self.metrics.add_gauge('streams', lambda: len(self.streams))
+        self.req_sent = {}
+
+        self.connection = None
+        self.channel = None
+        self.rpc_exchange = None
+        self.event_exchange = None
+        self.callback_queue = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        async with self.lock:
+            if self.connection is not None:
+                return self
+
+            self.connection = await aio_pika.connect_robust(self.url)
+            self.channel = await self.connection.channel()
+            self.rpc_exchange = await self.channel.declare_exchange(
+                self.rpc_exchange_name, aio_pika.ExchangeType.TOPIC, durable=True)
+            self.event_exchange = await self.channel.declare_exchange(
+                self.event_exchange_name, aio_pika.ExchangeType.TOPIC, durable=True)
+
+            # all replies are multiplexed onto one callback queue, like the
+            # greenthread client
+            self.callback_queue = await self.channel.declare_queue(
+                'cbq-'+uuid(), exclusive=True, auto_delete=True)
+            await self.callback_queue.consume(self.on_response, no_ack=True)
+        return self
+
+    def decode_message(self, message):
+        body = message.body
+        compression = (message.headers or {}).get('compression')
+        if compression:
+            body = decompress(body, compression)
+        return loads(body, message.content_type, message.content_encoding, accept=self.accept)
+
+    def encode_message(self, body, serializer, **kws):
+        content_type, content_encoding, data = serialize(body, serializer or self.serializer)
+        headers = kws.pop('headers', {})
+        if self.compression is not None:
+            data, mimetype = self.compression.compress(data, content_type)
+            if mimetype:
+                headers['compression'] = mimetype
+
+        return aio_pika.Message(
+            data,
+            content_type=content_type,
+            content_encoding=content_encoding,
+            headers=headers,
+            **kws)
+
+    async def on_response(self, message):
+        req_id = message.correlation_id
+        logger.debug(f"receiving response [{message.routing_key}, {req_id}]")
+
+        stream = self.streams.get(req_id)
+        if stream is not None:
+            await stream.on_reply((message.headers or {}).get(CREDIT_QUEUE_HEADER), self.decode_message(message))
+            return
+
+        fut = self.req_futures.pop(req_id, None)
+        if fut is None or fut.done():
+            logger.debug(f"dropping response for unknown request {req_id}")
+            return
+
+        label, sent_at = self.req_sent.pop(req_id, (None, None))
+        if label is not None:
+            self.metrics.observe('rpc_latency_seconds', time.time() - sent_at, {'method': label})
+
+        try:
+            payload = self.decode_message(message)
+            if rpc_is_batch(payload):
+                fut.set_result((req_id, rpc_decode_batch_rep(payload)))
+                return
+
+            error, result = rpc_decode_rep(payload)
+            fut.set_result((req_id, error, result))
+
+        except Exception as e:
+            fut.set_exception(e)
+
+    async def _open_stream(self, routing_key, meth, args, kws, timeout=None, window=16, serializer=None):
+        req_id = 'corr-'+uuid()
+        logger.debug(f"sending stream request: [{routing_key}, {req_id}] {meth}")
+        stream = AsyncRpcStream(self, routing_key, req_id, window, timeout)
+        await self._send(
+            routing_key, req_id, rpc_encode_req(req_id, meth, args, kws), serializer,
+            headers={METHOD_HEADER: meth, STREAM_HEADER: window}, waiter=stream)
+        return stream
+
+    async def _send_credit(self, req_id, credit, credit_queue):
+        message = self.encode_message(rpc_encode_credit(req_id, credit), None, correlation_id=req_id)
+        await self.channel.default_exchange.publish(message, routing_key=credit_queue)
+
+    async def _send(self, routing_key, req_id, body, serializer=None, headers=None, waiter=None, timeout=None):
+        await self.connect()
+
+        headers = dict(headers or {})
+        headers[SENT_AT_HEADER] = time.time()
+        if self.exc_traceback:
+            headers[EXC_TRACEBACK_HEADER] = True
+        if timeout is not None:
+            headers[DEADLINE_HEADER] = make_deadline(timeout)
+
+        # the server replies with the same serializer
+        message = self.encode_message(
+            body, serializer,
+            headers=headers,
+            expiration=timeout,
+            reply_to=self.callback_queue.name,
+            correlation_id=req_id)
+
+        label = headers.get(METHOD_HEADER, BATCH_LABEL)
+        self.metrics.inc('rpcs_total', {'method': label})
+        if waiter is None:
+            waiter = asyncio.get_running_loop().create_future()
+            waiters = self.req_futures
+            self.req_sent[req_id] = (label, headers[SENT_AT_HEADER])
+        else:
+            waiters = self.streams
+        waiters[req_id] = waiter
+
+        try:
+            await self.rpc_exchange.publish(message, routing_key=routing_key)
+        except BaseException:
+            waiters.pop(req_id, None)
+            self.req_sent.pop(req_id, None)
+            raise
+
+        return req_id, waiter
+
+    async def _send_request(self, routing_key, meth, args, kws, serializer=None, timeout=None):
+        req_id = 'corr-'+uuid()
+        logger.debug(f"sending request: [{routing_key}, {req_id}] {meth}")
+        return await self._send(
+            routing_key, req_id, rpc_encode_req(req_id, meth, args, kws), serializer,
+            headers={METHOD_HEADER: meth}, timeout=timeout)
+
+    async def _send_batch_request(self, routing_key, calls, serializer=None, timeout=None):
+        req_id = 'corr-'+uuid()
+        logger.debug(f"sending batch request: [{routing_key}, {req_id}] {len(calls)} calls")
+        return await self._send(routing_key, req_id, rpc_encode_batch_req(req_id, calls), serializer, timeout=timeout)
+
+    async def _wait_reply(self, req_id, fut, timeout=None):
+        try:
+            _, *ret = await asyncio.wait_for(fut, timeout)
+            return ret
+        except BaseException:
+            label, _ = self.req_sent.pop(req_id, (None, None))
+            if label is not None:
+                self.metrics.inc('rpc_abandoned_total', {'method': label})
+            raise
+        finally:
+            self.req_futures.pop(req_id, None)
+
+    async def call_async(self, routing_key, meth, *args, timeout=None, **kws):
+        req_id, fut = await self._send_request(routing_key, meth, args, kws, timeout=timeout)
+        return fut
+
+    async def call(self, routing_key, meth, *args, timeout=None, **kws):
+        req_id, fut = await self._send_request(routing_key, meth, args, kws, timeout=timeout)
+        return await self._wait_reply(req_id, fut, timeout)
+
+    async def call_stream(self, routing_key, meth, *args, timeout=None, window=16, **kws):
+        return await self._open_stream(routing_key, meth, args, kws, timeout, window)
+
+    async def call_many_async(self, routing_key, calls, serializer=None):
+        req_id, fut = await self._send_batch_request(routing_key, list(calls), serializer)
+        return fut
+
+    async def call_many(self, routing_key, calls, timeout=None, serializer=None):
+        calls = list(calls)
+        if not calls:
+            return []
+
+        req_id, fut = await self._send_batch_request(routing_key, calls, serializer, timeout=timeout)
+        replies, = await self._wait_reply(req_id, fut, timeout)
+        return replies
+
+    def encode_event(self, evt_type, evt_data, serializer=None):
+        return self.encode_message(
+            [evt_type, evt_data], serializer,
+            headers={EVENT_TYPE_HEADER: evt_type, SENT_AT_HEADER: time.time()},
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT)
+
+    async def publish(self, routing_key, evt_type, evt_data, serializer=None):
+        await self.connect()
+        message = self.encode_event(evt_type, evt_data, serializer)
+        await self.event_exchange.publish(message, routing_key=routing_key)
+
+    async def publish_many(self, routing_key, events, serializer=None):
+        await self.connect()
+        # the publisher confirms of the channel are awaited together
+        await asyncio.gather(*[
+            self.event_exchange.publish(self.encode_event(evt_type, evt_data, serializer), routing_key=routing_key)
+            for evt_type, evt_data in events])
+
+    async def release(self):
+        for fut in self.req_futures.values():
+            fut.cancel()
+        self.req_futures.clear()
+        self.req_sent.clear()
+
+        if self.connection is not None:
+            await self.connection.close()
+            self.connection = None
+
+    close = release
+    teardown = release
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.release()
+
+    async def get_stats(self, routing_key, timeout=None):
+        return await self.call(routing_key, STATS_RPC, timeout=timeout)
+
+    def get_pubber(self, routing_key, serializer=None):
+        return AsyncPublisher(self, routing_key, serializer=serializer)
+
+    def get_caller(self, routing_key, serializer=None):
+        return AsyncCaller(self, routing_key, serializer=serializer)
+
+def make_aio_client(conn=None, rpc_exchange=None, event_exchange=None, **kws):
+    # accepts the same conn values as make_client, a kombu Connection or url
+    url = get_connection(conn).as_uri(include_password=True)
+    # exchange names or kombu Exchanges
+    rpc_exchange = getattr(rpc_exchange, 'name', rpc_exchange) or RPC_EXCHANGE
+    event_exchange = getattr(event_exchange, 'name', event_exchange) or EVT_EXCHANGE
+    return AsyncMessageQueueClient(url, rpc_exchange=rpc_exchange, event_exchange=event_exchange, **kws)
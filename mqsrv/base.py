@@ -1,5 +1,6 @@
 from kombu import Connection, Exchange
 from .contract import RPC_EXCHANGE, EVT_EXCHANGE
+from .rpc_utils import serialize
 
 def get_rpc_exchange(name=None):
     if not name:
@@ -24,5 +25,41 @@ def get_connection(conn=None):
 
     return conn
 
-def declare_entity(obj, conn):
+def declare_entity(obj, conn, declared=None):
+    """
+    declares obj on conn, a connection or channel. with a set of what was
+    declared on it already, obj is only declared the first time.
+    """
+    key = (type(obj).__name__, obj.name)
+    if declared is not None and key in declared:
+        return False
     obj(conn).declare()
+    if declared is not None:
+        declared.add(key)
+    return True
+
+def encode_body(body, serializer, headers, shm=None, compression=None):
+    """
+    returns body and publish keywords. with a shm channel or a compression
+    policy the body is serialized here so its size can pick the path: large
+    bodies go through shm, otherwise they may get compressed.
+    """
+    if shm is None and compression is None:
+        return body, {'serializer': serializer, 'headers': headers}
+
+    content_type, content_encoding, data = serialize(body, serializer)
+    kws = {
+        'content_type': content_type,
+        'content_encoding': content_encoding,
+        'headers': headers,
+    }
+
+    if shm is not None and len(data) >= shm.threshold:
+        return shm.put(data, headers), kws
+
+    if compression is not None:
+        data, mimetype = compression.compress(data, content_type)
+        if mimetype:
+            headers['compression'] = mimetype
+
+    return data, kws
@@ -0,0 +1,129 @@
+import json
+import time
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+class Uncacheable(Exception):
+    """
+    arguments without a canonical form, calls with them run uncached
+    """
+
+def _dumps(v):
+    return json.dumps(v, separators=(',', ':'))
+
+def _canonical(v):
+    # containers other than lists become single key dicts tagged with their
+    # kind, so values of different kinds never encode the same
+    if v is None or isinstance(v, (bool, int, float, str)):
+        return v
+    if isinstance(v, (list, tuple)):
+        return [_canonical(i) for i in v]
+    if isinstance(v, dict):
+        # keys may mix types, sorting on their encoding always works
+        items = [[_canonical(k), _canonical(i)] for k, i in v.items()]
+        return {'d': sorted(items, key=lambda kv: _dumps(kv[0]))}
+    if isinstance(v, (set, frozenset)):
+        return {'s': sorted((_canonical(i) for i in v), key=_dumps)}
+    if isinstance(v, (bytes, bytearray)):
+        return {'b': bytes(v).hex()}
+    if isinstance(v, np.ndarray):
+        if v.dtype.hasobject:
+            raise Uncacheable("numpy arrays of objects")
+        digest = hashlib.sha256(np.ascontiguousarray(v).tobytes()).hexdigest()
+        return {'a': [v.dtype.str, list(v.shape), digest]}
+    if isinstance(v, np.generic):
+        return {'n': [v.dtype.str, _canonical(v.item())]}
+    raise Uncacheable(f"{type(v).__name__} values")
+
+def make_cache_key(meth, args, kws):
+    """
+    dict order and tuple vs list (json vs pickle callers) do not matter,
+    raises Uncacheable for values without a canonical form
+    """
+    return _dumps(_canonical([meth, args, kws]))
+
+def cacheable(maxsize=1024, ttl=None):
+    """
+    marks a function as cacheable for register_rpc, works on plain functions
+    and methods alike and leaves __rpc_name__ alone
+    """
+    def deco(fn):
+        fn.__rpc_cache__ = {'maxsize': maxsize, 'ttl': ttl}
+        return fn
+    return deco
+
+def single_flight(fn):
+    """
+    marks a function for register_rpc so identical concurrent calls share
+    one execution
+    """
+    fn.__rpc_single_flight__ = True
+    return fn
+
+class ResultCache:
+    """
+    bounded LRU of rpc results, entries older than ttl seconds are treated
+    as missing
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0,
+        }
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        """
+        returns (found, value)
+        """
+        item = self.data.get(key)
+        if item is None:
+            self.stats['misses'] += 1
+            return False, None
+
+        expires, value = item
+        if expires is not None and expires < time.monotonic():
+            self.data.pop(key)
+            self.stats['expirations'] += 1
+            self.stats['misses'] += 1
+            return False, None
+
+        self.data.move_to_end(key)
+        self.stats['hits'] += 1
+        return True, value
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+
+        self.data[key] = (expires, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.stats['invalidations'] += len(self.data)
+            self.data.clear()
+        elif self.data.pop(key, None) is not None:
+            self.stats['invalidations'] += 1
+
+def get_cache(cache):
+    if cache is None or cache is False:
+        return None
+    if isinstance(cache, ResultCache):
+        return cache
+    if cache is True:
+        return ResultCache()
+    return ResultCache(**cache)
@@ -1,58 +1,384 @@
+from . import monkey
 from loguru import logger
 import socket
+import queue
+import time
+from contextlib import contextmanager
 from kombu import Connection, Producer, Consumer, Queue, uuid, Exchange
 
 from greenthread.green import *
-from .rpc_utils import rpc_encode_req, rpc_decode_rep
-from .base import get_rpc_exchange, get_event_exchange, get_connection, declare_entity
+from .rpc_utils import ACCEPT_CONTENT, rpc_encode_req, rpc_decode_rep, rpc_encode_batch_req, rpc_decode_batch_rep, rpc_is_batch, rpc_decode_stream_rep, rpc_encode_credit
+from .base import get_rpc_exchange, get_event_exchange, get_connection, declare_entity, encode_body
+from .compression import get_compression
+from .contract import HOST_HEADER, EXC_TRACEBACK_HEADER, STREAM_HEADER, CREDIT_QUEUE_HEADER, DEADLINE_HEADER, METHOD_HEADER, EVENT_TYPE_HEADER, SENT_AT_HEADER, STATS_RPC
+from .deadline import make_deadline
+from .shm import HOST_ID, ShmChannel, decode_message, discard_message
+from .metrics import Metrics
+from .replica import ReplicaCaller
+
+# label of batch requests in client metrics
+BATCH_LABEL = '<batch>'
 
 class Publisher:
-    def __init__(self, client, routing_key):
+    def __init__(self, client, routing_key, serializer=None):
         self.client = client
         self.routing_key = routing_key
+        self.serializer = serializer
 
-    def publish(self, *args, **kws):
-        self.client.publish(self.routing_key, *args, **kws)
+    def publish(self, evt_type, evt_data):
+        self.client.publish(self.routing_key, evt_type, evt_data, serializer=self.serializer)
 
     def __call__(self, *args, **kws):
         self.publish(*args, **kws)
 
+    def publish_many(self, events, **kws):
+        self.client.publish_many(self.routing_key, events, serializer=self.serializer, **kws)
+
+class BatchConfirms:
+    """
+    publisher confirms of a channel awaited once per batch instead of after
+    every message, needs an amqp channel supporting confirm_select
+    """
+    def __init__(self, channel):
+        if not hasattr(channel, 'confirm_select'):
+            raise ValueError("publisher confirms need an amqp transport")
+
+        channel.confirm_select()
+        self.channel = channel
+        self.published = 0
+        self.confirmed = 0
+        self.nacked = 0
+        channel.events['basic_ack'].add(self.on_ack)
+        channel.events['basic_nack'].add(self.on_nack)
+
+    def on_ack(self, delivery_tag, multiple):
+        self.confirmed = max(self.confirmed, delivery_tag)
+
+    def on_nack(self, delivery_tag, multiple):
+        self.nacked += 1
+        self.confirmed = max(self.confirmed, delivery_tag)
+
+    def wait(self, conn, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while self.confirmed < self.published:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError(f"{self.published - self.confirmed} events not confirmed")
+            conn.drain_events(timeout=remaining)
+
+        if self.nacked:
+            nacked, self.nacked = self.nacked, 0
+            raise RuntimeError(f"broker rejected {nacked} events")
+
+class BufferedPublisher:
+    """
+    collects events and publishes them together once max_events are
+    buffered or max_delay seconds after the first one, on a connection and
+    channel of its own. publish blocks while a full buffer is flushed. with
+    confirm every flush waits for the broker acks of its events.
+
+    events of a background flush that fails are logged and dropped, flush()
+    and close() raise instead.
+    """
+    def __init__(self, client, routing_key, serializer=None, max_events=1000, max_delay=0.1, confirm=False, confirm_timeout=10):
+        self.client = client
+        self.routing_key = routing_key
+        self.serializer = serializer
+        self.max_events = max_events
+        self.max_delay = max_delay
+        self.confirm = confirm
+        self.confirm_timeout = confirm_timeout
+
+        self.entries = []
+        self.lock = Semaphore()
+        self.timer = None
+        self.conn = None
+        self.producer = None
+        self.confirms = None
+
+    def publish(self, evt_type, evt_data, routing_key=None):
+        self.entries.append((routing_key or self.routing_key, evt_type, evt_data))
+        if len(self.entries) >= self.max_events:
+            self.flush()
+        elif self.timer is None:
+            self.timer = green_spawn(self._flush_later)
+
+    def __call__(self, *args, **kws):
+        self.publish(*args, **kws)
+
+    def _flush_later(self):
+        green_sleep(self.max_delay)
+        self.timer = None
+        try:
+            self.flush()
+        except Exception as e:
+            logger.exception(e)
+
+    def _get_producer(self):
+        if self.producer is None:
+            self.conn = self.client.reply_conn.clone()
+            self.producer = Producer(self.conn)
+            if self.confirm:
+                self.confirms = BatchConfirms(self.producer.channel)
+            declare_entity(self.client.event_exchange, self.producer.channel)
+        return self.producer
+
+    def _reset(self):
+        # a broken channel is reopened by the next flush
+        try:
+            self.conn.release()
+        except Exception:
+            pass
+        self.conn = self.producer = self.confirms = None
+
+    def flush(self):
+        with self.lock:
+            entries, self.entries = self.entries, []
+            if not entries:
+                return
+
+            try:
+                producer = self._get_producer()
+                self.client._publish_events(producer, entries, self.serializer, self.confirms)
+                if self.confirms is not None:
+                    self.confirms.wait(self.conn, self.confirm_timeout)
+            except BaseException:
+                logger.error(f"failed to publish {len(entries)} buffered events")
+                self._reset()
+                raise
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.conn is not None:
+                self.conn.release()
+                self.conn = self.producer = self.confirms = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 class _Method:
-    def __init__(self, client, routing_key, method):
+    def __init__(self, client, routing_key, method, serializer=None):
         self.client = client
         self.routing_key = routing_key
         self.method = method
+        self.serializer = serializer
+
+    def __call__(self, *args, timeout=None, **kws):
+        req_id, evt = self.client._send_request(self.routing_key, self.method, args, kws, serializer=self.serializer, timeout=timeout)
+        return self.client._wait_reply(req_id, evt, timeout)
+
+    def call_async(self, *args, timeout=None, **kws):
+        req_id, evt = self.client._send_request(self.routing_key, self.method, args, kws, serializer=self.serializer, timeout=timeout)
+        return evt
+
+    def stream(self, *args, timeout=None, window=16, **kws):
+        return self.client._open_stream(self.routing_key, self.method, args, kws, timeout, window, serializer=self.serializer)
+
+class RpcStream:
+    """
+    iterates over the items yielded by a generator rpc as they arrive. the
+    server sends at most window items ahead of the consumer, credit for more
+    goes back once half of the window is consumed. an error raised by the
+    handler is raised here after the items sent before it.
+
+    credit goes to the process serving the stream, named by its replies. a
+    stream closed before its first reply is cancelled once that arrives.
+    """
+    def __init__(self, client, routing_key, req_id, window, timeout=None):
+        self.client = client
+        self.routing_key = routing_key
+        self.req_id = req_id
+        self.window = window
+        self.timeout = timeout
+
+        self.chunks = GreenQueue()
+        self.credit_queue = None
+        self.pending = {}
+        self.seq = 0
+        self.consumed = 0
+        self.done = False
+        self.cancelled = False
+
+    def feed(self, payload):
+        self.chunks.put(payload)
+
+    def on_reply(self, credit_queue, payload):
+        self.credit_queue = credit_queue or self.credit_queue
+        if not self.cancelled:
+            self.feed(payload)
+            return
+
+        # closed before the server was known
+        self.client.streams.pop(self.req_id, None)
+        if self.credit_queue and not rpc_decode_stream_rep(payload)[3]:
+            self.client._send_credit(self.req_id, -1, self.credit_queue)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+
+        # chunks come in order through one queue, seq only guards against
+        # anything reordering them on the way
+        while self.seq not in self.pending:
+            try:
+                payload = self.chunks.get(timeout=self.timeout)
+            except queue.Empty:
+                self.close()
+                raise TimeoutError(f"stream {self.req_id} timed out")
+
+            seq, error, result, end = rpc_decode_stream_rep(payload)
+            self.pending[seq] = (error, result, end)
+
+        error, result, end = self.pending.pop(self.seq)
+        self.seq += 1
+
+        if end:
+            self._finish()
+            if error:
+                et, ev, tb = error
+                raise ev.with_traceback(tb)
+            raise StopIteration
+
+        self.consumed += 1
+        if self.consumed >= max(1, self.window // 2):
+            self.client._send_credit(self.req_id, self.consumed, self.credit_queue)
+            self.consumed = 0
+        return result
+
+    def _finish(self):
+        self.done = True
+        self.client.streams.pop(self.req_id, None)
+
+    def close(self):
+        if self.done:
+            return
+        if self.credit_queue is None:
+            self.done = self.cancelled = True
+            return
+        self._finish()
+        self.client._send_credit(self.req_id, -1, self.credit_queue)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class _BatchMethod:
+    def __init__(self, batch, method):
+        self.batch = batch
+        self.method = method
 
     def __call__(self, *args, **kws):
-        return self.client.call(self.routing_key, self.method, *args, **kws)
+        return self.batch.add(self.method, *args, **kws)
+
+class Batch:
+    def __init__(self, client, routing_key, serializer=None):
+        self.client = client
+        self.routing_key = routing_key
+        self.serializer = serializer
+        self.entries = []
+
+    def add(self, meth, *args, **kws):
+        self.entries.append((meth, args, kws))
+        return len(self.entries) - 1
+
+    def __len__(self):
+        return len(self.entries)
 
-    def call_async(self, *args, **kws):
-        return self.client.call_async(self.routing_key, self.method, *args, **kws)
+    def __getattr__(self, meth):
+        return _BatchMethod(self, meth)
+
+    def call(self, timeout=None):
+        return self.client.call_many(self.routing_key, self.entries, timeout=timeout, serializer=self.serializer)
+
+    def call_async(self):
+        return self.client.call_many_async(self.routing_key, self.entries, serializer=self.serializer)
 
 class Caller:
-    def __init__(self, client, routing_key):
+    def __init__(self, client, routing_key, serializer=None):
         self.client = client
         self.routing_key = routing_key
+        self.serializer = serializer
 
     def __getattr__(self, meth):
-        return _Method(self.client, self.routing_key, meth)
+        return _Method(self.client, self.routing_key, meth, serializer=self.serializer)
+
+    def batch(self):
+        return Batch(self.client, self.routing_key, serializer=self.serializer)
     
+class PooledProducer:
+    """
+    a pooled connection with long-lived producers, the one on its default
+    channel and one on a channel in confirm mode, opened when first needed.
+    entities are declared once per channel.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.producer = Producer(conn)
+        self.declared = set()
+        self.confirm_producer = None
+        self.confirm_declared = set()
+        self.confirms = None
+
+    def declare(self, entity, confirm=False):
+        if confirm:
+            declare_entity(entity, self.confirm_producer.channel, self.confirm_declared)
+        else:
+            declare_entity(entity, self.producer.channel, self.declared)
+
+    def get_confirm_producer(self):
+        if self.confirm_producer is None:
+            channel = self.conn.channel()
+            self.confirms = BatchConfirms(channel)
+            self.confirm_producer = Producer(channel)
+        return self.confirm_producer
+
+    def reset(self):
+        # after a connection or channel error the channels are reopened and
+        # the entities declared again on the next use
+        self.conn.collect()
+        self.producer = Producer(self.conn)
+        self.declared = set()
+        self.confirm_declared = set()
+        self.confirm_producer = self.confirms = None
+
 class ConnectionPool:
     def __init__(self, conn, maxsize=10):
+        conn = get_connection(conn)
         self._resources = GreenQueue(maxsize)
         for _ in range(maxsize):
-            self._resources.put((get_connection(conn), Queue('cbq-'+uuid(), exclusive=True, auto_delete=True)))
-            
+            # a connection each, their channels are not shared between greenthreads
+            self._resources.put(PooledProducer(conn.clone()))
+
     def get(self):
         return self._resources.get()
-    
+
     def release(self, resource):
         self._resources.put(resource)
-        
+
+    @contextmanager
+    def acquire(self):
+        entry = self.get()
+        try:
+            yield entry
+        except entry.conn.connection_errors + entry.conn.channel_errors:
+            entry.reset()
+            raise
+        finally:
+            self.release(entry)
+
     def close(self):
         while not self._resources.empty():
-            conn, cbq = self._resources.get()
-            conn.release()
+            entry = self._resources.get()
+            entry.conn.release()
 
 class MessageQueueClient:
     def __init__(
@@ -61,7 +387,11 @@ class MessageQueueClient:
             rpc_exchange,
             event_exchange,
             serializer=None,
-            conn_pool_maxsize=1):
+            conn_pool_maxsize=1,
+            shm_threshold=None,
+            shm_dir=None,
+            compression=None,
+            exc_traceback=False):
 
         self.serializer = serializer
         conn_pool_maxsize = conn_pool_maxsize
@@ -76,90 +406,295 @@ class MessageQueueClient:
         
         self.should_stop = False
         self.req_events = {}
-        
+        self.streams = {}
+
         self.conn_pool = ConnectionPool(connection, conn_pool_maxsize)
         self.lock = Semaphore()
 
+        # all replies of this client are multiplexed onto one callback queue
+        # consumed by a single long-lived greenlet, see _start_reply_consumer
+        self.reply_conn = get_connection(connection).clone()
+        self.callback_queue = Queue('cbq-'+uuid(), exclusive=True, auto_delete=True)
+        self.reply_consumer = None
+        self.reply_runlet = None
+
+        # bodies above shm_threshold bytes exchanged with servers on this host
+        # skip the broker, see ShmChannel
+        self.shm = None
+        if shm_threshold:
+            self.shm = ShmChannel(shm_threshold, shm_dir)
+
+        # codec name, CompressionPolicy kws or instance
+        self.compression = get_compression(compression)
+
+        # ask servers to send tracebacks along with errors
+        self.exc_traceback = exc_traceback
+
+        # round trip latency by method, send times by request id
+        self.metrics = Metrics()
+        self.metrics.add_gauge('rpc_inflight', lambda: len(self.req_events))
+        self.metrics.add_gauge('streams', lambda: len(self.streams))
+        self.req_sent = {}
+
     def on_response(self, message):
         req_id = message.properties['correlation_id']
         callback_queue = message.delivery_info['routing_key']
         logger.debug(f"receiving response [{callback_queue}, {req_id}]")
 
-        if req_id in self.req_events:
-            error, result = rpc_decode_rep(message.payload)
-            self.req_events[req_id].set((req_id, error, result))
+        if self.shm:
+            self.shm.observe(message)
 
-    def call_async(self, routing_key, meth, *args, **kws):
-        conn, callback_queue = self.conn_pool.get()
-        req_id = 'corr-'+uuid()
-        logger.debug(f"sending request: [{routing_key}, {callback_queue.name}, {req_id}] {meth}")
+        stream = self.streams.get(req_id)
+        if stream is not None:
+            stream.on_reply((message.headers or {}).get(CREDIT_QUEUE_HEADER), decode_message(self.shm, message))
+            return
+
+        evt = self.req_events.pop(req_id, None)
+        if evt is None or evt.ready():
+            logger.debug(f"dropping response for unknown request {req_id}")
+            discard_message(self.shm, message)
+            return
 
-        self.req_events[req_id] = GreenEvent()
+        label, sent_at = self.req_sent.pop(req_id, (None, None))
+        if label is not None:
+            self.metrics.observe('rpc_latency_seconds', time.time() - sent_at, {'method': label})
 
+        payload = decode_message(self.shm, message)
+        if rpc_is_batch(payload):
+            evt.set((req_id, rpc_decode_batch_rep(payload)))
+            return
+
+        error, result = rpc_decode_rep(payload)
+        evt.set((req_id, error, result))
+
+    def _start_reply_consumer(self):
         with self.lock:
-            with Producer(conn) as producer:
-                producer.publish(
-                    rpc_encode_req(req_id, meth, args, kws),
+            if self.reply_consumer is not None:
+                return
+
+            # declaring here (not in the runlet) guarantees the callback
+            # queue exists before the first request referencing it is sent
+            self.reply_consumer = Consumer(
+                self.reply_conn,
+                accept=ACCEPT_CONTENT,
+                on_message=self.on_response,
+                queues=[self.callback_queue],
+                no_ack=True)
+            self.reply_consumer.consume()
+            self.reply_runlet = green_spawn(self._drain_replies)
+
+    def _drain_replies(self):
+        while not self.should_stop:
+            try:
+                # the timeout only bounds how long a stop request goes unnoticed,
+                # replies are dispatched as soon as they arrive
+                self.reply_conn.drain_events(timeout=1)
+            except socket.timeout:
+                continue
+            except self.reply_conn.connection_errors as e:
+                if self.should_stop:
+                    break
+                logger.exception(e)
+                green_sleep(1)
+                self._revive_reply_consumer()
+
+    def _revive_reply_consumer(self):
+        self.reply_conn = self.reply_conn.clone()
+        self.reply_consumer.revive(self.reply_conn.default_channel)
+        self.reply_consumer.consume()
+
+    def _send_request(self, routing_key, meth, args, kws, serializer=None, timeout=None, reply_event=None):
+        req_id = 'corr-'+uuid()
+        logger.debug(f"sending request: [{routing_key}, {self.callback_queue.name}, {req_id}] {meth}")
+        return self._send(
+            routing_key, req_id, rpc_encode_req(req_id, meth, args, kws), serializer,
+            headers={METHOD_HEADER: meth}, timeout=timeout, reply_event=reply_event)
+
+    def _send_batch_request(self, routing_key, calls, serializer=None, timeout=None):
+        req_id = 'corr-'+uuid()
+        logger.debug(f"sending batch request: [{routing_key}, {self.callback_queue.name}, {req_id}] {len(calls)} calls")
+        return self._send(routing_key, req_id, rpc_encode_batch_req(req_id, calls), serializer, timeout=timeout)
+
+    def _open_stream(self, routing_key, meth, args, kws, timeout=None, window=16, serializer=None):
+        req_id = 'corr-'+uuid()
+        logger.debug(f"sending stream request: [{routing_key}, {self.callback_queue.name}, {req_id}] {meth}")
+        stream = RpcStream(self, routing_key, req_id, window, timeout)
+        self._send(
+            routing_key, req_id, rpc_encode_req(req_id, meth, args, kws), serializer,
+            headers={METHOD_HEADER: meth, STREAM_HEADER: window}, waiter=stream)
+        return stream
+
+    def _send_credit(self, req_id, credit, credit_queue):
+        with self.conn_pool.acquire() as entry:
+            entry.producer.publish(
+                rpc_encode_credit(req_id, credit),
+                exchange='',
+                routing_key=credit_queue,
+                correlation_id=req_id,
+                serializer=self.serializer,
+            )
+
+    def _send(self, routing_key, req_id, body, serializer=None, headers=None, waiter=None, timeout=None, reply_event=None):
+        """
+        reply_event: set with the reply instead of a new event, requests
+        sharing one take the first reply, see ReplicaCaller
+        """
+        self._start_reply_consumer()
+
+        headers = dict(headers or {})
+        headers[SENT_AT_HEADER] = time.time()
+        if self.exc_traceback:
+            headers[EXC_TRACEBACK_HEADER] = True
+        if timeout is not None:
+            # the server skips the request once nobody waits for its reply
+            headers[DEADLINE_HEADER] = make_deadline(timeout)
+
+        shm = None
+        if self.shm:
+            headers[HOST_HEADER] = HOST_ID
+            if self.shm.is_local(routing_key):
+                shm = self.shm
+
+        # the server replies with the same serializer
+        body, publish_kws = encode_body(
+            body, serializer or self.serializer, headers,
+            shm=shm, compression=self.compression)
+        if timeout is not None:
+            # and the broker drops it if it is still queued by then
+            publish_kws['expiration'] = timeout
+
+        label = headers.get(METHOD_HEADER, BATCH_LABEL)
+        self.metrics.inc('rpcs_total', {'method': label})
+        if waiter is None:
+            waiter = GreenEvent() if reply_event is None else reply_event
+            waiters = self.req_events
+            self.req_sent[req_id] = (label, headers[SENT_AT_HEADER])
+        else:
+            waiters = self.streams
+        waiters[req_id] = waiter
+
+        try:
+            with self.conn_pool.acquire() as entry:
+                entry.declare(self.rpc_exchange)
+                entry.producer.publish(
+                    body,
                     exchange=self.rpc_exchange,
                     routing_key=routing_key,
-                    declare=[callback_queue],
-                    reply_to=callback_queue.name,
+                    reply_to=self.callback_queue.name,
                     correlation_id=req_id,
-                    serializer=self.serializer,
+                    **publish_kws,
                 )
-        
-        green_spawn(self._drain_events, conn, callback_queue, req_id)
-                
-        return self.req_events[req_id]
-    
-    def _drain_events(self, conn, callback_queue, req_id):
-        with self.lock:
-            with Consumer(conn,
-                        accept=['pickle', 'json'],
-                        on_message=self.on_response,
-                        queues=[callback_queue],
-                        no_ack=True):
-                while not self.req_events[req_id].ready() and not self.should_stop:
-                    try:
-                        conn.drain_events(timeout=0.1)
-                    except socket.timeout:
-                        continue
-                    
-                self.conn_pool.release((conn, callback_queue))
-
-    def call(self, *args, timeout=None, **kws):
-        evt = self.call_async(*args, **kws)
+        except BaseException:
+            waiters.pop(req_id, None)
+            self.req_sent.pop(req_id, None)
+            raise
+
+        return req_id, waiter
+
+    def call_async(self, routing_key, meth, *args, timeout=None, **kws):
+        req_id, evt = self._send_request(routing_key, meth, args, kws, timeout=timeout)
+        return evt
+
+    def _wait_reply(self, req_id, evt, timeout=None):
         try:
-            req_id, *ret = evt.get(timeout)
-            del self.req_events[req_id]
+            _, *ret = evt.get(timeout)
             return ret
         except BaseException as e:
-            evt.set(None)
+            self.req_events.pop(req_id, None)
+            label, _ = self.req_sent.pop(req_id, (None, None))
+            if label is not None:
+                # mostly timeouts, the reply is dropped if it comes later
+                self.metrics.inc('rpc_abandoned_total', {'method': label})
             raise e
 
-    def publish(self, routing_key, evt_type, evt_data):
-        conn, callback_queue = self.conn_pool.get()
-        with Producer(conn) as producer:
+    def call(self, routing_key, meth, *args, timeout=None, **kws):
+        req_id, evt = self._send_request(routing_key, meth, args, kws, timeout=timeout)
+        return self._wait_reply(req_id, evt, timeout)
+
+    def call_stream(self, routing_key, meth, *args, timeout=None, window=16, **kws):
+        return self._open_stream(routing_key, meth, args, kws, timeout, window)
+
+    def call_many_async(self, routing_key, calls, serializer=None):
+        req_id, evt = self._send_batch_request(routing_key, list(calls), serializer)
+        return evt
+
+    def call_many(self, routing_key, calls, timeout=None, serializer=None):
+        calls = list(calls)
+        if not calls:
+            return []
+
+        req_id, evt = self._send_batch_request(routing_key, calls, serializer, timeout=timeout)
+        replies, = self._wait_reply(req_id, evt, timeout)
+        return replies
+
+    def _publish_events(self, producer, entries, serializer=None, confirms=None):
+        serializer = serializer or self.serializer
+        for routing_key, evt_type, evt_data in entries:
+            body, publish_kws = encode_body(
+                [evt_type, evt_data], serializer,
+                {EVENT_TYPE_HEADER: evt_type, SENT_AT_HEADER: time.time()},
+                compression=self.compression)
             producer.publish(
-                [evt_type, evt_data],
+                body,
                 exchange=self.event_exchange,
                 routing_key=routing_key,
-                serializer=self.serializer,
+                **publish_kws,
             )
-        self.conn_pool.release((conn, callback_queue))
+            if confirms is not None:
+                confirms.published += 1
+
+    def publish(self, routing_key, evt_type, evt_data, serializer=None):
+        with self.conn_pool.acquire() as entry:
+            entry.declare(self.event_exchange)
+            self._publish_events(entry.producer, [(routing_key, evt_type, evt_data)], serializer)
+
+    def publish_many(self, routing_key, events, serializer=None, confirm=False, confirm_timeout=None):
+        """
+        publishes (evt_type, evt_data) pairs on one channel, with confirm
+        the broker acks of the whole batch are awaited once at the end
+        """
+        entries = [(routing_key, evt_type, evt_data) for evt_type, evt_data in events]
+        if not entries:
+            return
+
+        with self.conn_pool.acquire() as entry:
+            if not confirm:
+                entry.declare(self.event_exchange)
+                self._publish_events(entry.producer, entries, serializer)
+                return
+
+            producer = entry.get_confirm_producer()
+            entry.declare(self.event_exchange, confirm=True)
+            self._publish_events(producer, entries, serializer, entry.confirms)
+            entry.confirms.wait(entry.conn, confirm_timeout)
 
     def release(self):
         self.should_stop = True
+        if self.reply_runlet is not None:
+            green_thread_join(self.reply_runlet)
+        self.reply_conn.release()
         self.conn_pool.close()
+        if self.shm:
+            self.shm.release()
 
     close = release
     teardown = release
 
-    def get_pubber(self, routing_key):
-        return Publisher(self, routing_key)
+    def get_stats(self, routing_key, timeout=None):
+        # metrics of the server consuming routing_key
+        return self.call(routing_key, STATS_RPC, timeout=timeout)
+
+    def get_pubber(self, routing_key, serializer=None):
+        return Publisher(self, routing_key, serializer=serializer)
+
+    def get_buffered_pubber(self, routing_key, serializer=None, **kws):
+        return BufferedPublisher(self, routing_key, serializer=serializer, **kws)
+
+    def get_caller(self, routing_key, serializer=None):
+        return Caller(self, routing_key, serializer=serializer)
 
-    def get_caller(self, routing_key):
-        return Caller(self, routing_key)
+    def get_replica_caller(self, routing_keys, serializer=None, **kws):
+        return ReplicaCaller(self, routing_keys, serializer=serializer, **kws)
 
 def make_client(conn=None, rpc_exchange=None, event_exchange=None, **kws):
     # conn = get_connection(conn)
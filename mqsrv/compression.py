@@ -0,0 +1,87 @@
+import time
+from kombu.compression import compress, get_encoder
+
+class CompressionPolicy:
+    """
+    compresses serialized bodies of at least threshold bytes with a kombu
+    compression codec (zlib, bz2, lzma or any codec added through
+    kombu.compression.register). bodies whose compressed size is above
+    max_ratio of the original are sent as is.
+
+    a content type that keeps compressing badly is only probed every
+    probe_interval messages, so incompressible payloads stop costing cpu.
+    """
+    def __init__(self, codec='zlib', threshold=1024, max_ratio=0.9, probe_interval=16, decay=0.2):
+        get_encoder(codec)
+        self.codec = codec
+        self.threshold = threshold
+        self.max_ratio = max_ratio
+        self.probe_interval = probe_interval
+        self.decay = decay
+
+        self.ratios = {}
+        self.skips = {}
+        self.stats = {
+            'compressed': 0,
+            'skipped_small': 0,
+            'skipped_ratio': 0,
+            'skipped_probe': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'seconds': 0.,
+        }
+
+    @property
+    def ratio(self):
+        if not self.stats['bytes_in']:
+            return 1.
+        return self.stats['bytes_out'] / self.stats['bytes_in']
+
+    def should_try(self, size, content_type):
+        if size < self.threshold:
+            self.stats['skipped_small'] += 1
+            return False
+
+        if self.ratios.get(content_type, 0.) <= self.max_ratio:
+            return True
+
+        skips = self.skips.get(content_type, 0) + 1
+        if skips < self.probe_interval:
+            self.skips[content_type] = skips
+            self.stats['skipped_probe'] += 1
+            return False
+
+        self.skips[content_type] = 0
+        return True
+
+    def compress(self, data, content_type):
+        """
+        returns the body to send and the value of the compression header,
+        None when the body is left uncompressed
+        """
+        if not self.should_try(len(data), content_type):
+            return data, None
+
+        tic = time.perf_counter()
+        out, mimetype = compress(data, self.codec)
+        self.stats['seconds'] += time.perf_counter() - tic
+
+        ratio = len(out) / len(data)
+        last = self.ratios.get(content_type, ratio)
+        self.ratios[content_type] = last + self.decay * (ratio - last)
+
+        if ratio > self.max_ratio:
+            self.stats['skipped_ratio'] += 1
+            return data, None
+
+        self.stats['compressed'] += 1
+        self.stats['bytes_in'] += len(data)
+        self.stats['bytes_out'] += len(out)
+        return out, mimetype
+
+def get_compression(compression):
+    if compression is None or isinstance(compression, CompressionPolicy):
+        return compression
+    if isinstance(compression, str):
+        return CompressionPolicy(compression)
+    return CompressionPolicy(**compression)
@@ -1,2 +1,25 @@
 RPC_EXCHANGE = 'mqsrv_rpc_exchange'
 EVT_EXCHANGE = 'mqsrv_evt_exchange'
+
+HOST_HEADER = 'mqsrv_host'
+ROUTING_KEY_HEADER = 'mqsrv_routing_key'
+# set on replies from an exclusive rpc queue, no other server takes its requests
+EXCLUSIVE_HEADER = 'mqsrv_exclusive'
+SHM_HEADER = 'mqsrv_shm'
+SHM_SIZE_HEADER = 'mqsrv_shm_size'
+EXC_TRACEBACK_HEADER = 'mqsrv_exc_traceback'
+STREAM_HEADER = 'mqsrv_stream'
+# stream replies name the queue of the serving process taking credit for them
+CREDIT_QUEUE_HEADER = 'mqsrv_credit_queue'
+DEADLINE_HEADER = 'mqsrv_deadline'
+METHOD_HEADER = 'mqsrv_method'
+EVENT_TYPE_HEADER = 'mqsrv_event_type'
+SENT_AT_HEADER = 'mqsrv_sent_at'
+
+CACHE_INVALIDATE_EVENT = 'mqsrv_cache_invalidate'
+# every server process with a cache binds a queue of its own to this
+# routing key of the event exchange
+CACHE_INVALIDATE_ROUTING_KEY = 'mqsrv.cache.invalidate'
+
+# reserved rpc every server answers with its metrics
+STATS_RPC = 'mqsrv_stats'
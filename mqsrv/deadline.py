@@ -0,0 +1,34 @@
+"""
+requests sent with a timeout carry an absolute deadline in unix time, the
+server drops them once it has passed and handlers can ask how much of the
+caller's budget is left with remaining_time()
+"""
+import time
+from contextvars import ContextVar
+
+# each request runs in its own greenthread, which has its own context
+current_deadline = ContextVar('mqsrv_deadline', default=None)
+
+def make_deadline(timeout):
+    if timeout is None:
+        return None
+    return time.time() + timeout
+
+def is_expired(deadline, now=None):
+    if deadline is None:
+        return False
+    if now is None:
+        now = time.time()
+    return deadline <= now
+
+def get_deadline():
+    return current_deadline.get()
+
+def remaining_time():
+    """
+    seconds left before the caller stops waiting, None without a deadline
+    """
+    deadline = current_deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.time())
@@ -2,19 +2,37 @@ import sys
 import tblib
 import jsonpickle
 
-def pack_exc(error):
+# exception classes by qualified name, used to rebuild errors sent without
+# traceback. subclasses of BaseException register themselves.
+exc_classes = {}
+
+def get_exc_name(cls):
+    return f'{cls.__module__}.{cls.__qualname__}'
+
+def register_exc(cls, name=''):
+    exc_classes[name or get_exc_name(cls)] = cls
+    return cls
+
+def pack_exc(error, traceback=False):
     et, ev, tb = error
     assert isinstance(ev, BaseException)
 
-    tb = tblib.Traceback(tb).to_dict()
     out = ev.asdict()
-    out['raw'] = jsonpickle.encode([et, ev, tb])
+    out['type'] = get_exc_name(et)
+    if traceback:
+        tb = tblib.Traceback(tb).to_dict()
+        out['raw'] = jsonpickle.encode([et, ev, tb])
     return out
 
 def unpack_exc(error):
-    et, ev, tb = jsonpickle.decode(error['raw'])
-    tb = tblib.Traceback.from_dict(tb).as_traceback()
-    return et, ev, tb
+    if 'raw' in error:
+        et, ev, tb = jsonpickle.decode(error['raw'])
+        tb = tblib.Traceback.from_dict(tb).as_traceback()
+        return et, ev, tb
+
+    et = exc_classes.get(error.get('type'), BaseException)
+    ev = et.from_dict(error)
+    return et, ev, None
 
 class BaseException(Exception):
     def __init__(self, code=-1, msg='', data={}):
@@ -22,6 +40,10 @@ class BaseException(Exception):
         self.msg = msg
         self.data = data
 
+    def __init_subclass__(cls, **kws):
+        super().__init_subclass__(**kws)
+        register_exc(cls)
+
     def asdict(self):
         return {
             'code': self.code,
@@ -29,9 +51,30 @@ class BaseException(Exception):
             'data': self.data,
         }
 
+    @classmethod
+    def from_dict(cls, d):
+        # bypass __init__ of subclasses, their signatures vary
+        ev = cls.__new__(cls, d['code'], d['message'], d['data'])
+        BaseException.__init__(ev, d['code'], d['message'], d['data'])
+        return ev
+
+register_exc(BaseException)
+
 class JsonRpcError(BaseException):
     pass
 
 class MethodNotFound(JsonRpcError):
     def __init__(self, msg='', **kws):
         super().__init__(-32601, msg, **kws)
+
+class DeadlineExceeded(BaseException):
+    def __init__(self, msg='', **kws):
+        super().__init__(-32001, msg, **kws)
+
+class StreamStalled(BaseException):
+    def __init__(self, msg='', **kws):
+        super().__init__(-32002, msg, **kws)
+
+class PayloadMissing(BaseException):
+    def __init__(self, msg='', **kws):
+        super().__init__(-32003, msg, **kws)
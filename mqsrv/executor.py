@@ -0,0 +1,163 @@
+"""
+executors run blocking or cpu bound handlers off the green loop, the calling
+greenthread waits for the result without stalling other requests
+"""
+from . import monkey
+import os
+import inspect
+import contextvars
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from greenthread.green import *
+
+def offload(kind='thread', max_workers=None):
+    """
+    marks a function for register_rpc and register_event_handler to run on
+    a thread or process executor
+    """
+    def deco(fn):
+        fn.__mqsrv_executor__ = {'kind': kind, 'max_workers': max_workers}
+        return fn
+    return deco
+
+def call_handler(fn, args, kws):
+    # generators are drained where they run, only their items travel back
+    result = fn(*args, **kws)
+    if inspect.isgenerator(result):
+        result = list(result)
+    return result
+
+def _next_item(gen):
+    try:
+        return False, next(gen)
+    except StopIteration:
+        return True, None
+
+class ThreadExecutor:
+    """
+    runs handlers on the thread pool of the green backend, at most
+    max_workers at a time. the gevent pool is grown to fit all thread
+    executors, the eventlet one is sized by EVENTLET_THREADPOOL_SIZE.
+    """
+    reserved = 0
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.sem = Semaphore(max_workers)
+        ThreadExecutor.reserved += max_workers
+        self.sized_pid = None
+
+    def _ensure_tpool_size(self):
+        # the pool belongs to the hub, which forked workers recreate
+        if self.sized_pid == os.getpid():
+            return
+        self.sized_pid = os.getpid()
+        if USE_GREEN_BACKEND == 'gevent':
+            import gevent
+            threadpool = gevent.get_hub().threadpool
+            threadpool.maxsize = max(threadpool.maxsize, ThreadExecutor.reserved)
+
+    def run(self, fn, *args, **kws):
+        self._ensure_tpool_size()
+        # carries the request deadline over to the thread
+        ctx = contextvars.copy_context()
+        with self.sem:
+            return tpool_execute(ctx.run, fn, *args, **kws)
+
+    def call(self, fn, args, kws, stream=False):
+        if not stream:
+            return self.run(call_handler, fn, args, kws)
+
+        result = self.run(fn, *args, **kws)
+        if inspect.isgenerator(result):
+            return self.iterate(result)
+        return result
+
+    def iterate(self, gen):
+        # each item is produced on a thread as the stream asks for it
+        try:
+            while True:
+                done, item = self.run(_next_item, gen)
+                if done:
+                    return
+                yield item
+        finally:
+            self.run(gen.close)
+
+    def shutdown(self):
+        pass
+
+DEFAULT_MP_CONTEXT = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+
+class ProcessExecutor:
+    """
+    runs handlers in a pool of max_workers processes, handlers and their
+    arguments and results must be picklable, so handlers are module level
+    functions. generator handlers are drained in the worker process.
+
+    workers are forked by default, spawned ones import __main__ again and
+    would start another server there unless it is guarded by
+    if __name__ == '__main__'.
+    """
+    def __init__(self, max_workers=None, mp_context=DEFAULT_MP_CONTEXT):
+        self.max_workers = max_workers or os.cpu_count()
+        self.mp_context = mp_context
+        # started on first use, so forked server workers get their own
+        self.pool = None
+        self.pool_pid = None
+        # cancelled on shutdown, cancel_futures of shutdown needs python 3.9
+        self.futures = set()
+
+    def get_pool(self):
+        if self.pool is None or self.pool_pid != os.getpid():
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context(self.mp_context))
+            self.pool_pid = os.getpid()
+            self.futures = set()
+        return self.pool
+
+    def run(self, fn, *args, **kws):
+        evt = GreenEvent()
+        future = self.get_pool().submit(fn, *args, **kws)
+        self.futures.add(future)
+        # the pool's result thread is a greenthread once monkey patched
+        future.add_done_callback(evt.set)
+        future.add_done_callback(self.futures.discard)
+        return evt.get().result()
+
+    def call(self, fn, args, kws, stream=False):
+        result = self.run(call_handler, fn, args, kws)
+        if stream and inspect.isgeneratorfunction(fn):
+            return (i for i in result)
+        return result
+
+    def shutdown(self):
+        if self.pool is not None and self.pool_pid == os.getpid():
+            for future in list(self.futures):
+                future.cancel()
+            self.pool.shutdown(wait=False)
+        self.futures.clear()
+        self.pool = None
+
+EXECUTORS = {
+    'thread': ThreadExecutor,
+    'process': ProcessExecutor,
+}
+
+def get_executor(executor):
+    """
+    None, 'thread', 'process', {'kind': ..., 'max_workers': ...} or an
+    executor instance, which can be shared by several handlers
+    """
+    if executor is None or executor is False:
+        return None
+    if isinstance(executor, str):
+        executor = {'kind': executor}
+    if isinstance(executor, dict):
+        kws = dict(executor)
+        cls = EXECUTORS[kws.pop('kind', 'thread')]
+        if kws.get('max_workers') is None:
+            kws.pop('max_workers', None)
+        return cls(**kws)
+    return executor
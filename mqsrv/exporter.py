@@ -0,0 +1,79 @@
+from . import monkey
+import socket
+from loguru import logger
+from greenthread.green import *
+
+from .metrics import to_prometheus, write_prometheus
+
+class PrometheusExporter:
+    """
+    exposes a metrics snapshot in the prometheus text format, rewritten to
+    path every interval seconds (for the node exporter textfile collector)
+    and/or served over http on address, a (host, port) pair
+
+        exporter = PrometheusExporter(server.metrics.snapshot, address=('', 9464))
+        exporter.start()
+    """
+    def __init__(self, collect, path=None, address=None, interval=10, prefix='mqsrv'):
+        assert path or address
+        self.collect = collect
+        self.path = path
+        self.address = address
+        self.interval = interval
+        self.prefix = prefix
+
+        self.sock = None
+        self.runlets = []
+        self.should_stop = False
+
+    def render(self):
+        return to_prometheus(self.collect(), self.prefix)
+
+    def start(self):
+        if self.path:
+            self.runlets.append(green_spawn(self._write_loop))
+        if self.address:
+            self.sock = socket.create_server(self.address)
+            self.runlets.append(green_spawn(self._serve_loop))
+        return self
+
+    def stop(self):
+        self.should_stop = True
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.path:
+            self._write()
+
+    def _write(self):
+        try:
+            write_prometheus(self.path, self.render())
+        except Exception as e:
+            logger.exception(e)
+
+    def _write_loop(self):
+        while not self.should_stop:
+            self._write()
+            green_sleep(self.interval)
+
+    def _serve_loop(self):
+        while not self.should_stop:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            green_spawn(self._handle, conn)
+
+    def _handle(self, conn):
+        with conn:
+            try:
+                conn.settimeout(5)
+                # every path gets the metrics, the request is not parsed
+                conn.recv(65536)
+                body = self.render().encode()
+                conn.sendall(
+                    b'HTTP/1.0 200 OK\r\n'
+                    b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                    b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+            except OSError as e:
+                logger.debug(f"metrics request failed: {e}")
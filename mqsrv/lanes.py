@@ -0,0 +1,59 @@
+from . import monkey
+from loguru import logger
+from greenthread.green import *
+
+def get_partition_key(partition_key):
+    """
+    a callable taking the event data, or the name of a field of it
+    """
+    if callable(partition_key):
+        return partition_key
+
+    def get_field(evt_data):
+        try:
+            return evt_data[partition_key]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return get_field
+
+class EventLanes:
+    """
+    runs the events of a handler with the same partition key in the order
+    they arrived, on one of n_lanes lanes. lanes run in parallel, each on a
+    greenthread started by spawn while it has events queued. a lane queues
+    at most depth events, submitting to a full one waits for it.
+    """
+    def __init__(self, run, partition_key, spawn=green_spawn, n_lanes=16, depth=1000):
+        self.run = run
+        self.get_key = get_partition_key(partition_key)
+        self.spawn = spawn
+        self.queues = [GreenQueue(depth) for _ in range(n_lanes)]
+        self.running = [False] * n_lanes
+
+    def lane_of(self, evt_data):
+        # events whose key can not be taken or hashed still run, in order on
+        # the first lane
+        try:
+            return hash(self.get_key(evt_data)) % len(self.queues)
+        except Exception as e:
+            logger.warning(f"no partition key for event, using lane 0: {e!r}")
+            return 0
+
+    def submit(self, evt_type, evt_data, *args):
+        i = self.lane_of(evt_data)
+        self.queues[i].put((evt_type, evt_data) + args)
+        if not self.running[i]:
+            self.running[i] = True
+            self.spawn(self._drain, i)
+
+    def _drain(self, i):
+        queue = self.queues[i]
+        try:
+            while not queue.empty():
+                self.run(*queue.get())
+        finally:
+            self.running[i] = False
+
+    @property
+    def backlog(self):
+        return sum(queue.qsize() for queue in self.queues)
@@ -0,0 +1,132 @@
+"""
+in-process counters, latency histograms and gauges of servers and clients,
+read with Metrics.snapshot() or rendered in the prometheus text format
+"""
+import os
+import math
+import tempfile
+from bisect import bisect_left
+from collections import defaultdict
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def to_label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        # the last count is for values above all bounds
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def asdict(self):
+        return {
+            'bounds': list(self.bounds),
+            'counts': list(self.counts),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+class Metrics:
+    """
+    metrics are keyed by name and a dict of labels, e.g. {'method': 'add'},
+    gauges are callables read at snapshot time
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self.histograms = defaultdict(dict)
+        self.gauges = {}
+
+    def inc(self, name, labels=None, n=1):
+        self.counters[name][to_label_key(labels)] += n
+
+    def observe(self, name, value, labels=None):
+        key = to_label_key(labels)
+        hists = self.histograms[name]
+        hist = hists.get(key)
+        if hist is None:
+            hist = hists[key] = Histogram(self.buckets)
+        hist.observe(value)
+
+    def add_gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def reset(self):
+        self.counters.clear()
+        self.histograms.clear()
+
+    def snapshot(self):
+        """
+        plain lists and dicts, so it can be returned from an rpc
+        """
+        return {
+            'counters': {
+                name: [[dict(k), v] for k, v in values.items()]
+                for name, values in self.counters.items()
+            },
+            'histograms': {
+                name: [[dict(k), h.asdict()] for k, h in hists.items()]
+                for name, hists in self.histograms.items()
+            },
+            'gauges': {name: fn() for name, fn in self.gauges.items()},
+        }
+
+def format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    def escape(v):
+        return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels.items()) + '}'
+
+def format_value(v):
+    if math.isinf(v):
+        return '+Inf' if v > 0 else '-Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+def to_prometheus(snapshot, prefix='mqsrv'):
+    lines = []
+    for name, values in snapshot['counters'].items():
+        name = f'{prefix}_{name}'
+        lines.append(f'# TYPE {name} counter')
+        for labels, v in values:
+            lines.append(f'{name}{format_labels(labels)} {format_value(v)}')
+
+    for name, hists in snapshot['histograms'].items():
+        name = f'{prefix}_{name}'
+        lines.append(f'# TYPE {name} histogram')
+        for labels, h in hists:
+            total = 0
+            for bound, n in zip(h['bounds'], h['counts']):
+                total += n
+                lines.append(f'{name}_bucket{format_labels(labels, le=format_value(bound))} {total}')
+            lines.append(f'{name}_bucket{format_labels(labels, le="+Inf")} {h["count"]}')
+            lines.append(f'{name}_sum{format_labels(labels)} {format_value(h["sum"])}')
+            lines.append(f'{name}_count{format_labels(labels)} {h["count"]}')
+
+    for name, v in snapshot['gauges'].items():
+        name = f'{prefix}_{name}'
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {format_value(v)}')
+
+    return '\n'.join(lines) + '\n'
+
+def write_prometheus(path, text):
+    # replace the file atomically, collectors never see a partial write
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.mqsrv-metrics-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
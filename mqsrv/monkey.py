@@ -0,0 +1,6 @@
+# the greenthread based client, server and service need a patched process,
+# they import this first. importing mqsrv alone (e.g. for mqsrv.aio_client)
+# leaves the process untouched.
+import os
+os.environ['GREEN_BACKEND'] = 'gevent'
+from greenthread.monkey import monkey_patch; monkey_patch()
@@ -0,0 +1,138 @@
+from . import monkey
+import os
+import time
+import signal
+from loguru import logger
+from greenthread.green import *
+
+def exit_code(status):
+    # like os.waitstatus_to_exitcode of python 3.9, minus the signal number
+    # when killed by one
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+class Prefork:
+    """
+    runs a server in worker processes forked from this one. the workers
+    consume the same rpc queue, which must not be exclusive, and run the
+    setup/teardown of the registered contexts themselves. workers exiting
+    unexpectedly are restarted after restart_delay seconds. SIGTERM or SIGINT
+    stops all of them, each finishes running requests for up to
+    stop_timeout seconds before it is killed.
+
+    each worker takes at most rpc_prefetch_count unacked requests, with the
+    prefetch of one big pool the first worker would take all of them while
+    the others sit idle.
+
+    event queues are shared as well, so each event reaches one worker.
+    cache invalidations sent to CACHE_INVALIDATE_ROUTING_KEY reach all.
+    """
+    def __init__(self, server, workers, restart_delay=1, stop_timeout=30, rpc_prefetch_count=16):
+        if server.rpc_queue is not None and server.rpc_queue.exclusive:
+            raise ValueError("prefork workers need a shared rpc queue, use make_server(..., exclusive=False)")
+
+        if rpc_prefetch_count:
+            server.rpc_prefetch_count = min(server.rpc_prefetch_count, rpc_prefetch_count)
+            server.rpc_prefetch = server.rpc_prefetch_count
+
+        self.server = server
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.stop_timeout = stop_timeout
+
+        # worker slot by pid
+        self.children = {}
+        self.should_stop = False
+
+    def spawn(self, slot):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._run_worker(slot)
+            except BaseException as e:
+                logger.exception(e)
+                code = 1
+            finally:
+                os._exit(code)
+
+        logger.info(f"started worker {slot} pid {pid}")
+        self.children[pid] = slot
+        return pid
+
+    def _run_worker(self, slot):
+        server = self.server
+
+        def on_signal(signum, frame):
+            green_spawn(server.stop, self.stop_timeout)
+
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+
+        server.setup()
+        try:
+            server.run()
+        finally:
+            server.teardown()
+
+    def stop(self):
+        if self.should_stop:
+            return
+        logger.info("stopping workers...")
+        self.should_stop = True
+        self.kill(signal.SIGTERM)
+
+    def kill(self, signum):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+
+            slot = self.children.pop(pid, None)
+            if slot is None:
+                continue
+
+            code = exit_code(status)
+            if self.should_stop:
+                logger.info(f"worker {slot} pid {pid} exited with {code}")
+                continue
+
+            logger.warning(f"worker {slot} pid {pid} exited with {code}, restarting it")
+            green_sleep(self.restart_delay)
+            if not self.should_stop:
+                self.spawn(slot)
+
+    def run(self, poll_interval=0.5):
+        for slot in range(self.workers):
+            self.spawn(slot)
+
+        def on_signal(signum, frame):
+            self.stop()
+
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+
+        deadline = None
+        while self.children:
+            self.reap()
+            if self.should_stop:
+                if deadline is None:
+                    deadline = time.time() + self.stop_timeout + 5
+                elif time.time() > deadline:
+                    logger.warning(f"killing {len(self.children)} workers still running")
+                    self.kill(signal.SIGKILL)
+            green_sleep(poll_interval)
+
+        logger.info("workers stopped")
@@ -0,0 +1,131 @@
+from . import monkey
+import time
+import random
+from collections import deque
+from functools import partial
+
+from greenthread.green import *
+from .deadline import make_deadline
+
+def wait_event(evt, timeout):
+    # True once evt is set, gevent raises on timeout and eventlet returns
+    try:
+        evt.get(timeout)
+    except Timeout:
+        pass
+    return evt.ready()
+
+class Replica:
+    """
+    requests in flight and recent latencies of one routing key
+    """
+    def __init__(self, routing_key, window=100, alpha=0.2):
+        self.routing_key = routing_key
+        self.inflight = 0
+        self.alpha = alpha
+        # moving average, None until the first reply
+        self.latency = None
+        self.latencies = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.latencies.append(seconds)
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += self.alpha * (seconds - self.latency)
+
+    def load(self):
+        # expected wait of one more request
+        return (self.inflight + 1) * (self.latency or 0)
+
+    def percentile(self, q):
+        values = sorted(self.latencies)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+class ReplicaCaller:
+    """
+    calls methods served on several routing keys, each call goes to the
+    replica with the least expected wait: its requests in flight times its
+    recent latency.
+
+    with hedge, a percentile like 0.95, a call not answered within that
+    percentile of the replica's recent latencies is sent to a second
+    replica as well. the first reply wins and the other is dropped. at most
+    hedge_budget of the calls are hedged, so a slow set of replicas does not
+    get twice the load. hedge only methods that may run twice.
+    """
+    def __init__(self, client, routing_keys, serializer=None, hedge=None, hedge_budget=0.1, window=100, min_samples=10):
+        assert routing_keys
+        self.client = client
+        self.replicas = [Replica(k, window) for k in routing_keys]
+        self.serializer = serializer
+        self.hedge = hedge
+        self.hedge_budget = hedge_budget
+        self.min_samples = min_samples
+        self.calls = 0
+        self.hedges = 0
+
+    def __getattr__(self, meth):
+        return partial(self.call, meth)
+
+    def pick(self, exclude=None):
+        replicas = [r for r in self.replicas if r is not exclude]
+        return min(replicas, key=lambda r: (r.load(), r.inflight, random.random()))
+
+    def get_hedge_delay(self, replica):
+        if self.hedge is None or len(self.replicas) < 2:
+            return None
+        if self.hedges >= self.hedge_budget * self.calls:
+            return None
+        if len(replica.latencies) < self.min_samples:
+            return None
+        return replica.percentile(self.hedge)
+
+    def _send(self, replica, meth, args, kws, evt, sent, timeout):
+        req_id, _ = self.client._send_request(
+            replica.routing_key, meth, args, kws,
+            serializer=self.serializer, timeout=timeout, reply_event=evt)
+        replica.inflight += 1
+        sent[req_id] = (replica, time.time())
+
+    def _settle(self, sent):
+        # replies still to come are dropped by the client, the replicas
+        # that did not answer count the time waited as their latency
+        now = time.time()
+        for req_id, (replica, sent_at) in sent.items():
+            self.client.req_events.pop(req_id, None)
+            self.client.req_sent.pop(req_id, None)
+            replica.inflight -= 1
+            replica.observe(now - sent_at)
+
+    def call(self, meth, *args, timeout=None, **kws):
+        deadline = make_deadline(timeout)
+        evt = GreenEvent()
+        sent = {}
+        self.calls += 1
+
+        first = self.pick()
+        self._send(first, meth, args, kws, evt, sent, timeout)
+        try:
+            delay = self.get_hedge_delay(first)
+            if delay is not None and (timeout is None or delay < timeout) and not wait_event(evt, delay):
+                self.hedges += 1
+                self.client.metrics.inc('rpc_hedged_total', {'method': meth})
+                remaining = None if deadline is None else max(0, deadline - time.time())
+                self._send(self.pick(exclude=first), meth, args, kws, evt, sent, remaining)
+
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            _, *ret = evt.get(remaining)
+        except BaseException:
+            self.client.metrics.inc('rpc_abandoned_total', {'method': meth})
+            self._settle(sent)
+            raise
+
+        self._settle(sent)
+        return ret
+
+    def get_stats(self):
+        return {
+            r.routing_key: {'inflight': r.inflight, 'latency': r.latency}
+            for r in self.replicas
+        }
@@ -1,8 +1,13 @@
 import json
 import pickle
+import struct
+import numpy as np
 import msgpack
+# keep the unpatched codec, msgpack_numpy would copy every array into the stream
+from msgpack import Packer as _MsgPacker, ExtType, unpackb as _msg_unpackb
 import msgpack_numpy
 msgpack_numpy.patch()
+from kombu.serialization import register, registry, dumps
 
 from .exc import pack_exc, unpack_exc
 
@@ -11,10 +16,95 @@ def json_dumpb(v):
 def json_loadb(v):
     return json.loads(v.decode())
 
+MSGPACK_NUMPY = 'msgpack-numpy'
+_NDARRAY_EXT = 1
+_ALIGN = 64
+_HEADER = struct.Struct('<I')
+
+def _align(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+def msgpack_numpy_dumpb(v):
+    """
+    layout: [header size][msgpack header][pad][array buffers, each aligned]
+
+    arrays are replaced in the header by ext records pointing into the buffer
+    section, so their data is written once and can be mapped back without copy.
+    """
+    buffers = []
+    size = 0
+
+    def default(obj):
+        nonlocal size
+        if not isinstance(obj, (np.ndarray, np.generic)):
+            raise TypeError(f"can not serialize {type(obj)}")
+
+        arr = np.asarray(obj)
+        if not arr.flags.c_contiguous:
+            arr = np.ascontiguousarray(arr)
+        if arr.dtype.hasobject:
+            raise TypeError("can not serialize numpy arrays of objects")
+
+        dtype = arr.dtype.str if arr.dtype.fields is None else arr.dtype.descr
+        offset = _align(size)
+        if offset > size:
+            buffers.append(b'\0' * (offset - size))
+        buffers.append(arr.data.cast('B') if arr.nbytes else b'')
+        size = offset + arr.nbytes
+
+        meta = [dtype, arr.shape, offset, isinstance(obj, np.generic)]
+        return ExtType(_NDARRAY_EXT, _MsgPacker(use_bin_type=True).pack(meta))
+
+    header = _MsgPacker(default=default, use_bin_type=True).pack(v)
+    start = _align(_HEADER.size + len(header))
+    pad = b'\0' * (start - _HEADER.size - len(header))
+    return b''.join([_HEADER.pack(len(header)), header, pad, *buffers])
+
+def msgpack_numpy_loadb(v):
+    """
+    decoded arrays are read-only views over the message body
+    """
+    body = memoryview(v)
+    header_size, = _HEADER.unpack_from(body)
+    start = _align(_HEADER.size + header_size)
+
+    def ext_hook(code, data):
+        if code != _NDARRAY_EXT:
+            return ExtType(code, data)
+
+        dtype, shape, offset, is_scalar = _msg_unpackb(data, raw=False)
+        if isinstance(dtype, list):
+            dtype = [tuple(i) for i in dtype]
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape, dtype=np.int64))
+        arr = np.frombuffer(body, dtype=dtype, count=count, offset=start+offset).reshape(shape)
+        if is_scalar:
+            return arr[()]
+        return arr
+
+    return _msg_unpackb(body[_HEADER.size:_HEADER.size+header_size], ext_hook=ext_hook, raw=False)
+
+register(
+    MSGPACK_NUMPY, msgpack_numpy_dumpb, msgpack_numpy_loadb,
+    content_type='application/x-msgpack-numpy',
+    content_encoding='binary')
+
+ACCEPT_CONTENT = ['pickle', 'json', 'msgpack', MSGPACK_NUMPY]
+
+def get_serializer_name(content_type):
+    return registry.type_to_name.get(content_type)
+
+def serialize(body, serializer):
+    content_type, content_encoding, data = dumps(body, serializer=serializer)
+    if isinstance(data, str):
+        data = data.encode(content_encoding)
+    return content_type, content_encoding, data
+
 pack_funcs = {
     'json': (json_dumpb, json_loadb),
     'pickle': (pickle.dumps, pickle.loads),
     'msgpack': (msgpack.packb, msgpack.unpackb),
+    MSGPACK_NUMPY: (msgpack_numpy_dumpb, msgpack_numpy_loadb),
 }
 
 def rpc_encode_req(msgid, meth, args, kws):
@@ -28,9 +118,9 @@ def rpc_decode_req(data, check_id=None):
 
     return msgid, meth, args, kws
 
-def rpc_encode_rep(msgid, error=None, result=None):
+def rpc_encode_rep(msgid, error=None, result=None, traceback=False):
     if error:
-        error = pack_exc(error)
+        error = pack_exc(error, traceback=traceback)
     return [1, msgid, error, result]
 
 def rpc_decode_rep(data, check_id=None):
@@ -43,6 +133,71 @@ def rpc_decode_rep(data, check_id=None):
         error = unpack_exc(error)
     return error, result
 
+def rpc_encode_batch_req(msgid, calls):
+    return [3, msgid, [[meth, args, kws] for meth, args, kws in calls]]
+
+def rpc_decode_batch_req(data, check_id=None):
+    typ, msgid, calls = data
+    assert typ == 3
+    if check_id:
+        assert msgid == check_id
+
+    return msgid, [tuple(i) for i in calls]
+
+def rpc_encode_batch_rep(msgid, replies, traceback=False):
+    out = []
+    for error, result in replies:
+        if error:
+            error = pack_exc(error, traceback=traceback)
+        out.append([error, result])
+    return [4, msgid, out]
+
+def rpc_decode_batch_rep(data, check_id=None):
+    typ, msgid, replies = data
+    assert typ == 4
+    if check_id:
+        assert msgid == check_id
+
+    out = []
+    for error, result in replies:
+        if error:
+            error = unpack_exc(error)
+        out.append([error, result])
+    return out
+
+def rpc_is_batch(data):
+    return data[0] in (3, 4)
+
+def rpc_encode_stream_rep(msgid, seq, error=None, result=None, end=False, traceback=False):
+    if error:
+        error = pack_exc(error, traceback=traceback)
+    return [5, msgid, seq, error, result, end]
+
+def rpc_decode_stream_rep(data, check_id=None):
+    typ, msgid, seq, error, result, end = data
+    assert typ == 5
+    if check_id:
+        assert msgid == check_id
+
+    if error:
+        error = unpack_exc(error)
+    return seq, error, result, end
+
+def rpc_is_stream(data):
+    return data[0] == 5
+
+def rpc_encode_credit(msgid, credit):
+    # credit < 0 cancels the stream
+    return [6, msgid, credit]
+
+def rpc_decode_credit(data):
+    typ, msgid, credit = data
+    assert typ == 6
+    return msgid, credit
+
+def rpc_is_credit(data):
+    return data[0] == 6
+
 def rpc_encode_noti(meth, params):
     return [2, meth, params]
 
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+from . import monkey
 import sys
 import traceback
 import os
@@ -7,15 +8,29 @@ import atexit
 from functools import partial
 import inspect
 import socket
+import queue
+import time
+from collections import deque
 
 from loguru import logger
-from kombu import Connection, Queue, Exchange
+from kombu import Connection, Queue, Exchange, Producer, uuid
+from kombu.messaging import Consumer as KombuConsumer
 from kombu.mixins import ConsumerProducerMixin
 from greenthread.green import *
 
-from .rpc_utils import pack_funcs, rpc_decode_req, rpc_encode_rep
-from .base import get_connection, get_rpc_exchange, get_event_exchange
-from .exc import BaseException, MethodNotFound
+from .rpc_utils import ACCEPT_CONTENT, get_serializer_name, pack_funcs, rpc_decode_req, rpc_encode_rep, rpc_decode_batch_req, rpc_encode_batch_rep, rpc_is_batch, rpc_encode_stream_rep, rpc_decode_credit
+from .base import get_connection, get_rpc_exchange, get_event_exchange, encode_body
+from .compression import get_compression
+from .exc import BaseException, MethodNotFound, DeadlineExceeded, StreamStalled, PayloadMissing
+from .contract import HOST_HEADER, ROUTING_KEY_HEADER, EXCLUSIVE_HEADER, EXC_TRACEBACK_HEADER, STREAM_HEADER, CREDIT_QUEUE_HEADER, DEADLINE_HEADER, METHOD_HEADER, EVENT_TYPE_HEADER, SENT_AT_HEADER, CACHE_INVALIDATE_EVENT, CACHE_INVALIDATE_ROUTING_KEY, STATS_RPC
+from .cache import get_cache, make_cache_key, Uncacheable
+from .shm import HOST_ID, ShmChannel, decode_message, discard_message
+from .deadline import current_deadline, is_expired
+from .metrics import Metrics
+from .prefork import Prefork
+from .executor import get_executor
+from .topic import TopicIndex
+from .lanes import EventLanes
 
 def format_function_name(fn):
     if hasattr(fn, '__rpc_name__'):
@@ -39,6 +54,17 @@ def format_function_name(fn):
     else:
         raise
 
+def pool_free_slots(pool):
+    # gevent pools expose free_count(), eventlet pools free()
+    if hasattr(pool, 'free_count'):
+        return pool.free_count()
+    return pool.free()
+
+EVENT_OVERLOAD_POLICIES = ('block', 'drop_oldest', 'dead_letter')
+
+# prefetch_count of basic.qos is a 16 bit field
+MAX_PREFETCH_COUNT = 65535
+
 class MessageQueueServer(ConsumerProducerMixin):
 
     def __init__(self,
@@ -46,7 +72,19 @@ class MessageQueueServer(ConsumerProducerMixin):
                  rpc_queue,
                  event_queues,
                  serializer=None,
-                 pool_size=10000):
+                 pool_size=10000,
+                 rpc_prefetch_count=None,
+                 shm_threshold=None,
+                 shm_dir=None,
+                 compression=None,
+                 exc_traceback=False,
+                 stream_timeout=60,
+                 event_ack=False,
+                 event_prefetch_count=None,
+                 event_max_pending=None,
+                 event_concurrency=None,
+                 event_overload='block',
+                 event_dead_letter=None):
 
         self.connection = connection
         self.rpc_queue = rpc_queue
@@ -54,58 +92,247 @@ class MessageQueueServer(ConsumerProducerMixin):
         self.serializer = serializer
 
         self.pool = GreenPool(pool_size)
+        # upper bound of unacked rpc requests, the effective prefetch also
+        # follows the free slots of self.pool, see _update_rpc_flow. it
+        # defaults to the pool size, so requests do not wait on the broker
+        # round trip of every ack while slots are free
+        self.rpc_prefetch_count = min(rpc_prefetch_count or pool_size, pool_size, MAX_PREFETCH_COUNT)
+        self.rpc_prefetch = self.rpc_prefetch_count
+        self.rpc_inflight = 0
+        self.rpc_consumer = None
+        self.rpc_paused = False
+        self.event_consumer = None
+
+        # with event_ack, events are acked once all their handlers finished
+        # and the broker sends at most event_prefetch_count unacked ones.
+        # at most event_max_pending events are received and not finished, an
+        # event over that is handled by the event_overload policy:
+        #   block: waits for a pending event to finish
+        #   drop_oldest: drops the oldest event not started yet, they wait
+        #     while event_concurrency events are running
+        #   dead_letter: publishes the event to the event_dead_letter routing
+        #     key of the exchange it came from
+        if event_overload not in EVENT_OVERLOAD_POLICIES:
+            raise ValueError(f"event_overload must be one of {EVENT_OVERLOAD_POLICIES}")
+        if event_overload == 'dead_letter' and not event_dead_letter:
+            raise ValueError("the dead_letter policy needs an event_dead_letter routing key")
+        self.event_ack = event_ack
+        self.event_prefetch_count = min(event_prefetch_count or event_max_pending or pool_size, MAX_PREFETCH_COUNT)
+        self.event_max_pending = event_max_pending
+        self.event_slots = Semaphore(event_max_pending) if event_max_pending else None
+        self.event_concurrency = event_concurrency
+        self.event_overload = event_overload
+        self.event_dead_letter = event_dead_letter
+        self.event_waiting = deque()
+        self.event_pending = 0
+        self.event_running = 0
+        self.event_starting = False
+        # consumers with a channel of their own, see get_consumers
+        self.channels = []
+        self.credit_queue = None
+
         self.ctx_pool = GreenPool(pool_size)
+        # batch entries get their own pool so a batch worker holding a slot
+        # of self.pool never waits on slots of the same pool
+        self.batch_pool = GreenPool(pool_size)
+
+        # replies above shm_threshold bytes to clients on this host skip the
+        # broker, see ShmChannel
+        self.shm = None
+        if shm_threshold:
+            self.shm = ShmChannel(shm_threshold, shm_dir)
+
+        # codec name, CompressionPolicy kws or instance, applies to replies
+        self.compression = get_compression(compression)
+
+        # error replies carry code, message and data only, tracebacks are
+        # packed when this is set or the request asks for them
+        self.exc_traceback = exc_traceback
+
+        # credit queues of running streams by request id, a stream waiting
+        # longer than stream_timeout for credit is dropped
+        self.streams = {}
+        self.stream_timeout = stream_timeout
 
         self.rpcs = {}
-        self.event_handlers = {}
+        self.rpc_caches = {}
+        self.rpc_flights = {}
+        self.rpc_flight_stats = {}
+        self.rpc_executors = {}
+        # every executor in use, shut down on teardown
+        self.executors = []
+        self.cache_invalidation_id = None
+        self.event_handlers = TopicIndex()
+        # ordered handlers by cb id
+        self.event_lanes = {}
         self.exc_handlers = {}
         self.ctxs = {}
         self.evt_cb_id = 0
         self.exc_handler_id = 0
 
-        self.is_setuped = False
+        # replies go through one producer on the default channel of the
+        # producer connection, the mixin would build one per reply
+        self._reply_producer = None
 
-    def register_rpc(self, fn, name=''):
+        self.is_setuped = False
+        self.is_stopping = False
+
+        # request, error and latency metrics by rpc method and event type
+        self.metrics = Metrics()
+        self.metrics.add_gauge('pool_size', lambda: self.pool.size)
+        self.metrics.add_gauge('pool_busy', lambda: self.pool.size - pool_free_slots(self.pool))
+        self.metrics.add_gauge('rpc_inflight', lambda: self.rpc_inflight)
+        self.metrics.add_gauge('rpc_prefetch', lambda: self.rpc_prefetch)
+        self.metrics.add_gauge('streams', lambda: len(self.streams))
+        self.metrics.add_gauge('event_pending', lambda: self.event_pending)
+        self.metrics.add_gauge('event_running', lambda: self.event_running)
+        self.metrics.add_gauge('event_lane_backlog', lambda: sum(lanes.backlog for lanes in self.event_lanes.values()))
+        self.register_rpc(self.get_stats, STATS_RPC)
+
+    def register_rpc(self, fn, name='', cache=None, single_flight=None, executor=None):
+        """
+        cache: True, ResultCache kws or instance to cache results of an
+        idempotent rpc by its arguments, defaults to what @cacheable set
+
+        single_flight: identical concurrent calls wait on one execution and
+        share its result or error, defaults to what @single_flight set
+
+        executor: 'thread', 'process', executor kws or instance to run a
+        blocking handler off the green loop, defaults to what @offload set
+        """
         if not name:
             name = format_function_name(fn)
 
         assert name not in self.rpcs
         self.rpcs[name] = fn
+
+        if cache is None:
+            cache = getattr(fn, '__rpc_cache__', None)
+        cache = get_cache(cache)
+        if cache is not None:
+            self.rpc_caches[name] = cache
+            if self.cache_invalidation_id is None:
+                self.cache_invalidation_id = self.register_event_handler(CACHE_INVALIDATE_EVENT, self._on_cache_invalidate)
+
+        if single_flight is None:
+            single_flight = getattr(fn, '__rpc_single_flight__', False)
+        if single_flight:
+            self.rpc_flights[name] = {}
+            self.rpc_flight_stats[name] = {'calls': 0, 'coalesced': 0}
+
+        executor = self._get_executor(fn, executor)
+        if executor is not None:
+            self.rpc_executors[name] = executor
+
         logger.info(f'register_rpc: {name} {fn.__name__}')
         return name
 
     def unregister_rpc(self, name):
         if name in self.rpcs:
-            self.rpcs.pop(name)
+            fn = self.rpcs.pop(name)
+            self.rpc_caches.pop(name, None)
+            self.rpc_flights.pop(name, None)
+            self.rpc_flight_stats.pop(name, None)
+            self.rpc_executors.pop(name, None)
             logger.info(f'unregister_rpc: {name} {fn.__name__}')
 
-    def register_event_handler(self, evt_type, cb):
-        if evt_type not in self.event_handlers:
-            self.event_handlers[evt_type] = {}
+    def invalidate_cache(self, meth=None, args=None, kws=None):
+        """
+        drops the cached result of one call, all results of meth, or
+        everything when meth is not given
+        """
+        if meth is None:
+            caches = self.rpc_caches.values()
+        elif meth in self.rpc_caches:
+            caches = [self.rpc_caches[meth]]
+        else:
+            return
+
+        key = None
+        if meth is not None and (args is not None or kws is not None):
+            try:
+                key = make_cache_key(meth, args or [], kws or {})
+            except Uncacheable:
+                # never cached either
+                return
 
-        handlers = self.event_handlers[evt_type]
+        for cache in caches:
+            cache.invalidate(key)
 
+    def _on_cache_invalidate(self, evt_type, evt_data):
+        evt_data = evt_data or {}
+        self.invalidate_cache(evt_data.get('method'), evt_data.get('args'), evt_data.get('kws'))
+
+    def _on_invalidate_message(self, message):
+        evt_type, evt_data = message.payload
+        if evt_type == CACHE_INVALIDATE_EVENT:
+            self._on_cache_invalidate(evt_type, evt_data)
+
+    def get_cache_stats(self):
+        return {k: dict(v.stats, size=len(v)) for k, v in self.rpc_caches.items()}
+
+    def get_flight_stats(self):
+        return {k: dict(v, running=len(self.rpc_flights[k])) for k, v in self.rpc_flight_stats.items()}
+
+    def get_stats(self):
+        return dict(
+            self.metrics.snapshot(),
+            cache=self.get_cache_stats(),
+            flight=self.get_flight_stats())
+
+    def _observe_rpc_wait(self, meth, sent_at, received_at):
+        # broker queueing from publish to delivery, then the wait for a slot
+        # of self.pool, sent_at comes from the publisher's clock
+        labels = {'method': meth}
+        if sent_at is not None:
+            self.metrics.observe('rpc_queue_seconds', max(0.0, received_at - sent_at), labels)
+        self.metrics.observe('rpc_pool_wait_seconds', time.time() - received_at, labels)
+
+    def _observe_call(self, kind, labels, started, failed=False):
+        self.metrics.inc(f'{kind}s_total', labels)
+        if failed:
+            self.metrics.inc(f'{kind}_errors_total', labels)
+        self.metrics.observe(f'{kind}_latency_seconds', time.time() - started, labels)
+
+    def _get_executor(self, fn, executor):
+        if executor is None:
+            executor = getattr(fn, '__mqsrv_executor__', None)
+        executor = get_executor(executor)
+        if executor is not None:
+            self.executors.append(executor)
+        return executor
+
+    def register_event_handler(self, evt_type, cb, executor=None, partition_key=None, lanes=16, lane_depth=1000):
+        """
+        evt_type: an event type or a pattern of them, like 'user.*' or
+        'order.#', see TopicIndex
+        executor: like for register_rpc
+        partition_key: a field name of the event data or a callable taking
+        it. events with the same key are handled one after the other in
+        the order they arrived, on one of lanes lanes queueing up to
+        lane_depth events each, see EventLanes
+        """
         self.evt_cb_id += 1
         cb_id = self.evt_cb_id
 
-        assert cb_id not in handlers
-        handlers[cb_id] = cb
         logger.info(f'register_event_handler: {evt_type} {cb.__name__}')
+        executor = self._get_executor(cb, executor)
+        if executor is not None:
+            cb = partial(executor.run, cb)
+        if partition_key is not None:
+            cb = EventLanes(
+                partial(self._event_worker, cb), partition_key,
+                spawn=self.pool.spawn, n_lanes=lanes, depth=lane_depth)
+            self.event_lanes[cb_id] = cb
+        self.event_handlers.add(evt_type, cb_id, cb)
         return cb_id
 
     def unregister_event_handler(self, cb_id):
-        evt_type = None
-        for k, v in self.event_handlers.items():
-            if cb_id in v:
-                evt_type = k
-                break
-
-        if not evt_type:
+        evt_type = self.event_handlers.remove(cb_id)
+        if evt_type is None:
             return
-
-        self.event_handlers[evt_type].pop(cb_id)
-        if not self.event_handlers[evt_type]:
-            self.event_handlers.pop(evt_type)
+        # queued events of its lanes still run
+        self.event_lanes.pop(cb_id, None)
 
         logger.info(f'unregister_event_handler: {evt_type} {cb_id}')
 
@@ -131,103 +358,599 @@ class MessageQueueServer(ConsumerProducerMixin):
 
         self.ctxs[name] = ctx
 
+    @property
+    def reply_producer(self):
+        if self._reply_producer is None:
+            self._reply_producer = Producer(self.producer_connection)
+        return self._reply_producer
+
+    def on_consume_end(self, connection, channel):
+        super().on_consume_end(connection, channel)
+        self._reply_producer = None
+        for ch in self.channels:
+            try:
+                ch.close()
+            except Exception as e:
+                logger.debug(f"closing channel failed: {e}")
+        self.channels = []
+
     def get_consumers(self, Consumer, channel):
         out = []
+        self.rpc_consumer = None
+        self.rpc_paused = False
+        self.event_consumer = None
         if self.rpc_queue:
-            out.append(Consumer(
+            self.rpc_prefetch = max(1, self._get_rpc_prefetch())
+            self.rpc_consumer = Consumer(
                 on_message=self._on_rpc_message,
                 queues=[self.rpc_queue],
-                prefetch_count=1,
-                accept=['pickle', 'json']
+                prefetch_count=self.rpc_prefetch,
+                accept=ACCEPT_CONTENT
+            )
+            out.append(self.rpc_consumer)
+
+            # stream credit skips the rpc queue, where it would wait behind
+            # requests, for a pool slot or for a paused consumer, and could
+            # reach another worker sharing the queue. each connection of
+            # each process gets its own queue, on its own channel so the
+            # prefetch of the rpc consumer does not hold it back.
+            self.credit_queue = Queue('mqsrv-credit-'+uuid(), exclusive=True, auto_delete=True)
+            credit_channel = channel.connection.client.channel()
+            self.channels.append(credit_channel)
+            out.append(KombuConsumer(
+                credit_channel,
+                on_message=self._on_credit_message,
+                queues=[self.credit_queue],
+                accept=ACCEPT_CONTENT,
+                no_ack=True,
             ))
 
-        if self.event_queues:
-            out.append(Consumer(
+        if self.rpc_caches:
+            # invalidations reach every process, a shared event queue would
+            # hand each of them to one prefork worker only
+            exchange = self.event_queues[0].exchange if self.event_queues else get_event_exchange()
+            invalidate_queue = Queue(
+                'mqsrv-invalidate-'+uuid(), exchange=exchange, routing_key=CACHE_INVALIDATE_ROUTING_KEY,
+                exclusive=True, auto_delete=True)
+            invalidate_channel = channel.connection.client.channel()
+            self.channels.append(invalidate_channel)
+            out.append(KombuConsumer(
+                invalidate_channel,
+                on_message=self._on_invalidate_message,
+                queues=[invalidate_queue],
+                accept=ACCEPT_CONTENT,
+                no_ack=True,
+            ))
+
+        if self.event_queues and self.event_ack:
+            # a channel of its own, the prefetch of the rpc consumer would
+            # apply to it otherwise
+            event_channel = channel.connection.client.channel()
+            self.channels.append(event_channel)
+            self.event_consumer = KombuConsumer(
+                event_channel,
+                on_message=self._on_event_message,
+                queues=self.event_queues,
+                prefetch_count=self.event_prefetch_count,
+                accept=ACCEPT_CONTENT,
+            )
+            out.append(self.event_consumer)
+        elif self.event_queues:
+            self.event_consumer = Consumer(
                 on_message=self._on_event_message,
                 queues=self.event_queues,
-                accept=['pickle', 'json'],
+                accept=ACCEPT_CONTENT,
                 no_ack=True
-            ))
+            )
+            out.append(self.event_consumer)
 
         return out
 
 
-    def send_reply(self, message, result=None, error=None):
+    def _publish_reply(self, message, body, ack=True, headers=None):
         req_id = message.properties['correlation_id']
         routing_key = message.properties['reply_to']
         logger.debug(f"sending reply [{routing_key}, {req_id}])")
 
-        self.producer.publish(
-            rpc_encode_rep(req_id, result=result, error=error),
-            exchange='',
-            routing_key=routing_key,
-            correlation_id=req_id,
-            serializer=self.serializer,
-            retry=True,
-        )
-        message.ack()
+        headers = dict(headers or {})
+        shm = None
+        if self.shm:
+            headers[HOST_HEADER] = HOST_ID
+            headers[ROUTING_KEY_HEADER] = message.delivery_info['routing_key']
+            headers[EXCLUSIVE_HEADER] = bool(self.rpc_queue.exclusive)
+            if (message.headers or {}).get(HOST_HEADER) == HOST_ID:
+                shm = self.shm
+
+        body, publish_kws = encode_body(
+            body, self.get_reply_serializer(message), headers,
+            shm=shm, compression=self.compression)
+
+        publish_kws.update(exchange='', routing_key=routing_key, correlation_id=req_id)
+        conn = self.producer_connection
+        try:
+            self.reply_producer.publish(body, **publish_kws)
+        except conn.connection_errors + conn.channel_errors as e:
+            # only a failed reply pays for the retrying publish, it revives
+            # the channel of the producer
+            logger.warning(f"sending reply [{routing_key}, {req_id}] failed: {e}, retrying")
+            self.reply_producer.publish(body, retry=True, **publish_kws)
+        if ack:
+            message.ack()
+
+    def _get_rpc_prefetch(self):
+        free = pool_free_slots(self.pool)
+        return min(self.rpc_prefetch_count, self.rpc_inflight + free)
+
+    def _update_rpc_flow(self):
+        # rpc workers share self.pool with event and exception handlers. when
+        # those eat the slots the broker could still push more requests than
+        # we can run, so the prefetch of the rpc consumer shrinks to the free
+        # slots, or the consumer is cancelled and new requests stay in the
+        # queue instead of piling up here. prefetch grows back once slots are
+        # released. each change costs a cancel, basic.qos and consume round
+        # trip, so prefetch only follows when the target doubled or halved,
+        # or reached the bounds. pool.spawn blocking in _on_rpc_message remains the hard
+        # bound on in-flight work.
+        consumer = self.rpc_consumer
+        if consumer is None or self.is_stopping:
+            return
+
+        target = self._get_rpc_prefetch()
+        if target < 1:
+            if not self.rpc_paused:
+                logger.debug("rpc pool saturated, pausing rpc consumer")
+                consumer.cancel()
+                self.rpc_paused = True
+            return
+
+        prefetch = self.rpc_prefetch
+        should_grow = target > prefetch and (target >= 2 * prefetch or target == self.rpc_prefetch_count)
+        should_shrink = 2 * target < prefetch
+        if not (self.rpc_paused or should_shrink or should_grow):
+            return
+
+        logger.debug(f"rpc consumer prefetch {prefetch} -> {target}")
+        # a new prefetch only applies to consumers started after basic.qos
+        if not self.rpc_paused:
+            consumer.cancel()
+        consumer.qos(prefetch_count=target)
+        consumer.consume()
+        self.rpc_prefetch = target
+        self.rpc_paused = False
+
+    def on_iteration(self):
+        self._update_rpc_flow()
+
+    def get_reply_serializer(self, message):
+        # reply in the serializer chosen by the caller for this request
+        return get_serializer_name(message.content_type) or self.serializer
+
+    def want_traceback(self, message):
+        return self.exc_traceback or bool((message.headers or {}).get(EXC_TRACEBACK_HEADER))
+
+    def send_reply(self, message, result=None, error=None):
+        req_id = message.properties['correlation_id']
+        with_tb = error is not None and self.want_traceback(message)
+        self._publish_reply(message, rpc_encode_rep(req_id, result=result, error=error, traceback=with_tb))
+
+    def send_batch_reply(self, message, replies):
+        req_id = message.properties['correlation_id']
+        with_tb = self.want_traceback(message)
+        self._publish_reply(message, rpc_encode_batch_rep(req_id, replies, traceback=with_tb))
+
+    def send_stream_reply(self, message, seq, result=None, error=None, end=False):
+        req_id = message.properties['correlation_id']
+        with_tb = error is not None and self.want_traceback(message)
+        body = rpc_encode_stream_rep(req_id, seq, result=result, error=error, end=end, traceback=with_tb)
+        self._publish_reply(message, body, ack=False, headers={CREDIT_QUEUE_HEADER: self.credit_queue.name})
 
     def handle_exception(self, e):
         logger.exception(e)
         for h in self.exc_handlers.values():
             self.pool.spawn(h, e)
 
-    def _rpc_worker(self, message):
-        req_id = message.properties['correlation_id']
-        _, meth, args, kws = rpc_decode_req(message.payload)
-        logger.debug(f"reciving request [{self.rpc_queue.name}, {req_id}] {meth}")
-        send_reply = partial(self.send_reply, message)
+    def _call_rpc(self, meth, args, kws, stream=False):
+        executor = self.rpc_executors.get(meth)
+        if executor is None:
+            return self.rpcs[meth](*args, **kws)
+        return executor.call(self.rpcs[meth], args, kws, stream=stream)
+
+    def _invoke_rpc(self, meth, args, kws, stream=False):
+        if stream:
+            return self._call_rpc(meth, args, kws, stream=True)
+
+        cache = self.rpc_caches.get(meth)
+        flights = self.rpc_flights.get(meth)
+        if cache is not None or flights is not None:
+            try:
+                key = make_cache_key(meth, args, kws)
+            except Uncacheable as e:
+                logger.debug(f"calling {meth} uncached: {e}")
+                cache = flights = None
+
+        if cache is not None:
+            found, result = cache.get(key)
+            if found:
+                return result
+
+        flight = None
+        if flights is not None:
+            flight = flights.get(key)
+            if flight is not None:
+                # an identical call is running, share its outcome
+                self.rpc_flight_stats[meth]['coalesced'] += 1
+                ok, value = flight.get()
+                if ok:
+                    return value
+                if value is None:
+                    # the leader was killed or timed out rather than failed,
+                    # the waiters run the call again, one of them leading
+                    return self._invoke_rpc(meth, args, kws)
+                et, ev, tb = value
+                raise ev.with_traceback(tb)
+
+            self.rpc_flight_stats[meth]['calls'] += 1
+            flight = flights[key] = GreenEvent()
+
+        outcome = (False, None)
+        try:
+            result = self._call_rpc(meth, args, kws)
+            if inspect.isgenerator(result):
+                # callers not asking for a stream get all items at once
+                result = list(result)
+
+            if cache is not None:
+                cache.set(key, result)
+            outcome = (True, result)
+            return result
+
+        except Exception:
+            outcome = (False, sys.exc_info())
+            raise
+
+        finally:
+            if flight is not None:
+                flights.pop(key, None)
+                flight.set(outcome)
 
+    def _apply_rpc(self, req_id, meth, args, kws, stream=False, deadline=None):
+        current_deadline.set(deadline)
+        started = time.time()
+        # unknown methods are not labels, callers could make up any number
+        labels = {'method': meth} if meth in self.rpcs else None
         try:
             if meth not in self.rpcs:
                 raise MethodNotFound(f"method {meth} not found!")
 
-            result = self.rpcs[meth](*args, **kws)
+            if is_expired(deadline):
+                raise DeadlineExceeded(f"deadline of {meth} passed before it ran")
+
+            result = self._invoke_rpc(meth, args, kws, stream=stream)
 
         except BaseException as e:
             logger.error(f"BaseException for request id {req_id}")
-            send_reply(error=sys.exc_info())
+            error = sys.exc_info()
             self.handle_exception(e)
+            if labels:
+                self._observe_call('rpc', labels, started, failed=True)
+            return error, None
 
         except Exception as e:
             # we need to handle generic Exception BUG here
+            logger.error(f"BUG for request id {req_id}")
+            logger.exception(e)
+            if labels:
+                self._observe_call('rpc', labels, started, failed=True)
+            raise
+
+        if labels:
+            self._observe_call('rpc', labels, started)
+        return None, result
+
+    def _rpc_worker(self, message, received_at):
+        headers = message.headers or {}
+        deadline = headers.get(DEADLINE_HEADER)
+        if is_expired(deadline):
+            # the caller gave up waiting, running it only adds to the backlog
+            logger.debug(f"dropping expired request [{self.rpc_queue.name}, {message.properties.get('correlation_id')}]")
+            self.metrics.inc('rpc_expired_total')
+            discard_message(self.shm, message)
+            message.ack()
+            return
+
+        meth = headers.get(METHOD_HEADER)
+        if meth is not None and meth not in self.rpcs:
+            return self._reject_rpc(message, meth)
+
+        try:
+            payload = decode_message(self.shm, message)
+        except (OSError, ValueError) as e:
+            # a shm segment is gone when the request reached a server on
+            # another host, or its ttl passed before it was read
+            return self._reject_missing_payload(message, e)
+        if rpc_is_batch(payload):
+            return self._rpc_batch_worker(message, payload, deadline, received_at)
+
+        req_id = message.properties['correlation_id']
+        _, meth, args, kws = rpc_decode_req(payload)
+        logger.debug(f"reciving request [{self.rpc_queue.name}, {req_id}] {meth}")
+        if meth in self.rpcs:
+            self._observe_rpc_wait(meth, headers.get(SENT_AT_HEADER), received_at)
+
+        window = (message.headers or {}).get(STREAM_HEADER)
+        if window:
+            return self._rpc_stream_worker(message, req_id, meth, args, kws, window)
+
+        error, result = self._apply_rpc(req_id, meth, args, kws, deadline=deadline)
+        self.send_reply(message, result=result, error=error)
+
+    def _reject_rpc(self, message, meth):
+        # the method travels in the headers, so unknown ones fail without
+        # decoding their arguments
+        req_id = message.properties['correlation_id']
+        discard_message(self.shm, message)
+        error, _ = self._apply_rpc(req_id, meth, (), {})
+        if (message.headers or {}).get(STREAM_HEADER):
+            self.send_stream_reply(message, 0, error=error, end=True)
+            message.ack()
+        else:
+            self.send_reply(message, error=error)
+
+    def _reject_missing_payload(self, message, e):
+        req_id = message.properties['correlation_id']
+        logger.warning(f"body of request [{self.rpc_queue.name}, {req_id}] is gone: {e}")
+        self.metrics.inc('rpc_payload_missing_total')
+        try:
+            raise PayloadMissing(f"request body in shared memory is gone: {e}")
+        except PayloadMissing:
+            error = sys.exc_info()
+
+        if (message.headers or {}).get(STREAM_HEADER):
+            self.send_stream_reply(message, 0, error=error, end=True)
+            message.ack()
+        else:
+            self.send_reply(message, error=error)
+
+    def _on_stream_credit(self, payload):
+        req_id, credit = rpc_decode_credit(payload)
+        credits = self.streams.get(req_id)
+        if credits is not None:
+            credits.put(credit)
+
+    def _on_credit_message(self, message):
+        self._on_stream_credit(message.payload)
+
+    def _rpc_stream_worker(self, message, req_id, meth, args, kws, window):
+        error, result = self._apply_rpc(req_id, meth, args, kws, stream=True)
+        if error:
+            self.send_stream_reply(message, 0, error=error, end=True)
+            message.ack()
+            return
+
+        if not inspect.isgenerator(result):
+            # plain results make a stream of one item
+            self.send_stream_reply(message, 0, result=result)
+            self.send_stream_reply(message, 1, end=True)
+            message.ack()
+            return
+
+        # the client grants window items up front and more credit as it
+        # consumes them, a negative credit cancels the stream
+        credits = GreenQueue()
+        self.streams[req_id] = credits
+        seq = 0
+        try:
+            for item in result:
+                while not credits.empty() or window <= 0:
+                    try:
+                        credit = credits.get(timeout=self.stream_timeout)
+                    except queue.Empty:
+                        # ends the stream with an error, the client may
+                        # wait without a timeout
+                        raise StreamStalled(f"stream stalled after {seq} items, no credit for {self.stream_timeout}s")
+                    if credit < 0:
+                        logger.debug(f"stream cancelled [{req_id}] after {seq} items")
+                        return
+                    window += credit
+
+                self.send_stream_reply(message, seq, result=item)
+                seq += 1
+                window -= 1
+
+        except BaseException as e:
+            logger.error(f"BaseException for request id {req_id}")
+            self.send_stream_reply(message, seq, error=sys.exc_info(), end=True)
+            self.handle_exception(e)
+            self.metrics.inc('rpc_errors_total', {'method': meth})
+
+        except Exception as e:
             logger.error(f"BUG for request id {req_id}")
             logger.exception(e)
             raise
 
         else:
-            send_reply(result=result)
+            self.send_stream_reply(message, seq, end=True)
+
+        finally:
+            self.streams.pop(req_id, None)
+            result.close()
+            # acked whatever happened, redelivering a half sent stream would
+            # duplicate items
+            message.ack()
+
+    def _rpc_batch_worker(self, message, payload, deadline, received_at):
+        req_id = message.properties['correlation_id']
+        _, calls = rpc_decode_batch_req(payload)
+        logger.debug(f"reciving batch request [{self.rpc_queue.name}, {req_id}] {len(calls)} calls")
+
+        sent_at = (message.headers or {}).get(SENT_AT_HEADER)
+        for meth in {call[0] for call in calls if call[0] in self.rpcs}:
+            self._observe_rpc_wait(meth, sent_at, received_at)
+
+        def worker(call):
+            meth, args, kws = call
+            return self._apply_rpc(req_id, meth, args, kws, deadline=deadline)
+
+        replies = list(green_pool_map(self.batch_pool, worker, calls))
+        self.send_batch_reply(message, replies)
+
+    def _rpc_task(self, message, received_at):
+        try:
+            self._rpc_worker(message, received_at)
+        finally:
+            self.rpc_inflight -= 1
 
     def _on_rpc_message(self, message):
-        self.pool.spawn(self._rpc_worker, message)
+        self.rpc_inflight += 1
+        self.pool.spawn(self._rpc_task, message, time.time())
 
-    def _event_worker(self, cb, evt_type, evt_data):
+    def _event_worker(self, cb, evt_type, evt_data, received_at, done=None, pattern=None):
         logger.debug(f"reciving event [{evt_type}])")
+        started = time.time()
+        # labelled with the pattern the handler was registered with, event
+        # types matched by wildcards could make up any number of labels
+        labels = {'event_type': evt_type if pattern is None else pattern}
+        self.metrics.observe('event_pool_wait_seconds', started - received_at, labels)
         try:
             cb(evt_type, evt_data)
 
         except BaseException as e:
-            logger(f"BaseException for event {evt_type}")
+            logger.error(f"BaseException for event {evt_type}")
             self.handle_exception(e)
+            self._observe_call('event', labels, started, failed=True)
 
         except Exception as e:
             logger.error(f"BUG for event {evt_type}")
             logger.exception(e)
+            self._observe_call('event', labels, started, failed=True)
+
+        else:
+            self._observe_call('event', labels, started)
+
+        finally:
+            if done is not None:
+                done()
+
+    def _settle_event(self, message):
+        if not self.event_ack:
+            return
+        try:
+            message.ack()
+        except self.connection.connection_errors + self.connection.channel_errors as e:
+            # the broker sends it again
+            logger.warning(f"acking event failed: {e}")
+
+    def _reserve_event(self, message, label):
+        # takes one of event_max_pending slots, False if the event was dead
+        # lettered instead
+        if self.event_slots is None:
+            self.event_pending += 1
+            return True
+
+        if not self.event_slots.acquire(blocking=False):
+            if self.event_overload == 'drop_oldest' and self.event_waiting:
+                dropped, dropped_type, _, handlers, _ = self.event_waiting.popleft()
+                logger.warning(f"too many pending events, dropping event {dropped_type}")
+                self.metrics.inc('events_dropped_total', {'event_type': handlers[0][0]})
+                self._finish_event(dropped)
+            elif self.event_overload == 'dead_letter':
+                self._dead_letter_event(message, label)
+                return False
+            self.event_slots.acquire()
+
+        self.event_pending += 1
+        return True
+
+    def _finish_event(self, message):
+        self.event_pending -= 1
+        if self.event_slots is not None:
+            self.event_slots.release()
+        self._settle_event(message)
+
+    def _dead_letter_event(self, message, label):
+        logger.warning(f"too many pending events, dead lettering event {label}")
+        self.metrics.inc('events_dead_lettered_total', {'event_type': label})
+        # the body as it came, still serialized and compressed
+        self.reply_producer.publish(
+            message.body,
+            exchange=message.delivery_info['exchange'],
+            routing_key=self.event_dead_letter,
+            content_type=message.content_type,
+            content_encoding=message.content_encoding,
+            headers=message.headers,
+            retry=True,
+        )
+        self._settle_event(message)
+
+    def _start_events(self):
+        # a single greenthread starts events, so handlers on lanes get them
+        # in the order they arrived
+        if self.event_starting:
+            return
+        self.event_starting = True
+        try:
+            while self.event_waiting:
+                if self.event_concurrency is not None and self.event_running >= self.event_concurrency:
+                    return
+                if self.event_ack and self.is_stopping:
+                    # left unacked, the broker sends them again
+                    return
+                self._start_event(*self.event_waiting.popleft())
+        finally:
+            self.event_starting = False
+
+    def _start_event(self, message, evt_type, evt_data, handlers, received_at):
+        self.event_running += 1
+        left = [len(handlers)]
+
+        def done():
+            left[0] -= 1
+            if left[0]:
+                return
+            self.event_running -= 1
+            self._finish_event(message)
+            if self.event_waiting:
+                green_spawn(self._start_events)
+
+        for pattern, cb in handlers:
+            if isinstance(cb, EventLanes):
+                cb.submit(evt_type, evt_data, received_at, done, pattern)
+            else:
+                self.pool.spawn(self._event_worker, cb, evt_type, evt_data, received_at, done, pattern)
 
     def _on_event_message(self, message):
+        # skip decoding events nobody here handles, the payload is only
+        # deserialized on access
+        evt_type = (message.headers or {}).get(EVENT_TYPE_HEADER)
+        if evt_type is not None and not self.event_handlers.match(evt_type):
+            self._settle_event(message)
+            return
+
+        received_at = time.time()
         evt_type, evt_data = message.payload
-        if evt_type not in self.event_handlers:
+        handlers = self.event_handlers.match(evt_type)
+        if not handlers:
+            self._settle_event(message)
             return
 
-        for cb in self.event_handlers[evt_type].values():
-            self.pool.spawn(self._event_worker, cb, evt_type, evt_data)
+        # per event metrics go by the first matching pattern
+        label = handlers[0][0]
+        sent_at = (message.headers or {}).get(SENT_AT_HEADER)
+        if sent_at is not None:
+            self.metrics.observe('event_queue_seconds', max(0.0, received_at - sent_at), {'event_type': label})
+
+        if not self._reserve_event(message, label):
+            return
+        self.event_waiting.append((message, evt_type, evt_data, handlers, received_at))
+        self._start_events()
 
     def apply_to_ctx(self, meth, *args, **kws):
         def worker(ctx):
             getattr(ctx, meth)(*args, **kws)
 
         ctxs = [i for i in self.ctxs.values() if hasattr(i, meth)]
-        self.ctx_pool.imap(worker, ctxs)
+        # consume the results, imap only spawns the workers lazily
+        list(green_pool_map(self.ctx_pool, worker, ctxs))
         green_pool_join(self.ctx_pool)
 
         green_pool_join(self.pool)
@@ -241,12 +964,36 @@ class MessageQueueServer(ConsumerProducerMixin):
         self.is_setuped = True
         logger.info("server setuped.")
 
+    def stop(self, timeout=30):
+        """
+        stops taking requests and events, waits up to timeout seconds for
+        the running ones to finish and then leaves run()
+        """
+        if self.is_stopping:
+            return
+        self.is_stopping = True
+        if self.rpc_consumer is not None and not self.rpc_paused:
+            self.rpc_consumer.cancel()
+            self.rpc_paused = True
+        if self.event_consumer is not None:
+            # events left in the queue go to the next server instead of
+            # being lost with this process
+            self.event_consumer.cancel()
+
+        logger.info("server stopping...")
+        green_pool_join(self.pool, timeout)
+        self.should_stop = True
+
     def teardown(self):
         if not self.is_setuped:
             return
 
         logger.info("server tearing down...")
         self.apply_to_ctx('teardown')
+        for executor in self.executors:
+            executor.shutdown()
+        if self.shm:
+            self.shm.release()
         self.is_setuped = False
         logger.info("server teared down.")
 
@@ -256,7 +1003,7 @@ def to_pair(v):
     assert isinstance(v, tuple) and len(v) == 2
     return v
 
-def make_server(conn=None, rpc_routing_key=None, event_routing_keys=[], rpc_exchange=None, event_exchange=None, rpc_queue=None, event_queues=[], **kws):
+def make_server(conn=None, rpc_routing_key=None, event_routing_keys=[], rpc_exchange=None, event_exchange=None, rpc_queue=None, event_queues=[], exclusive=True, **kws):
     if isinstance(event_routing_keys, str):
         event_routing_keys = [event_routing_keys]
 
@@ -267,7 +1014,8 @@ def make_server(conn=None, rpc_routing_key=None, event_routing_keys=[], rpc_exch
     if rpc_queue or rpc_routing_key:
         if rpc_queue is None:
             q_name, routing_key = to_pair(rpc_routing_key)
-            rpc_queue = Queue(q_name, routing_key=routing_key, exchange=rpc_exchange, exclusive=True, auto_delete=True)
+            # a shared queue outlives restarts of the workers consuming it
+            rpc_queue = Queue(q_name, routing_key=routing_key, exchange=rpc_exchange, exclusive=exclusive, auto_delete=exclusive)
 
     if not isinstance(event_exchange, Exchange):
         event_exchange = get_event_exchange(event_exchange)
@@ -298,12 +1046,23 @@ def wait_for_connection(addr, max_tries):
         else:
             break
 
-def run_server(server, block=True, max_tries=10):
+def run_server(server, block=True, max_tries=10, workers=1, **prefork_kws):
+    """
+    workers: run the server in this many forked processes, see Prefork
+    """
     conn = server.connection
     logger.info(f'starting at {conn.as_uri()}')
 
     wait_for_connection((conn.hostname, conn.port), max_tries)
 
+    if workers > 1:
+        prefork = Prefork(server, workers, **prefork_kws)
+        if not block:
+            green_spawn(prefork.run)
+            return prefork
+        prefork.run()
+        return
+
     def shutdown():
         server.teardown()
         logger.info("server teardown")
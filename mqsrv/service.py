@@ -1,6 +1,16 @@
+from . import monkey
 from greenthread.green import *
 
 import uuid
+import time
+import queue
+from collections import deque
+from functools import partial
+from loguru import logger
+
+from .exc import DeadlineExceeded
+from .deadline import make_deadline, is_expired, get_deadline, remaining_time
+from .metrics import Metrics
 
 class ServiceBase:
     def __init__(self, name, event_handler=None, events={}, rpc_prefix='', debug=False, validate=False):
@@ -22,14 +32,27 @@ class ServiceBase:
             self.event_handler(evt_type, evt_data)
 
 class RunnerBase(ServiceBase):
-    def __init__(self, name, *args, interval=0.01, **kws):
+    """
+    without a task_q, run() polls is_idle() every interval seconds and
+    calls process(). with one, it waits on the queue and hands its items to
+    process_batch() as soon as they arrive, up to batch_size of them,
+    waiting at most batch_timeout seconds to fill a batch.
+    """
+    def __init__(self, name, *args, interval=0.01, task_q=None, batch_size=1, batch_timeout=0, **kws):
         super().__init__(name, *args, **kws)
 
         self.should_stop = False
         self.interval = interval
         self.runlet = None
 
+        self.task_q = task_q
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+
     def run(self):
+        if self.task_q is not None:
+            return self.run_batches()
+
         while not self.should_stop:
             if self.is_idle():
                 green_sleep(self.interval)
@@ -37,42 +60,206 @@ class RunnerBase(ServiceBase):
 
             self.process()
 
+    def run_batches(self):
+        while not self.should_stop:
+            batch = self.task_q.get_batch(self.batch_size, self.batch_timeout)
+            if not batch:
+                continue
+
+            try:
+                results = self.process_batch([d for _, d in batch])
+                assert len(results) == len(batch)
+            except Exception as e:
+                logger.exception(e)
+                # the callers waiting on the batch get the error raised
+                results = [e] * len(batch)
+
+            for (req_id, _), result in zip(batch, results):
+                self.task_q.send(req_id, result)
+
     def process(self):
         raise NotImplementedError
 
+    def process_batch(self, batch):
+        """
+        returns a result for each item of batch, in the same order
+        """
+        raise NotImplementedError
+
     def setup(self):
         self.runlet = green_spawn(self.run)
 
     def teardown(self):
         self.should_stop = True
-        self.runlet.wait()
+        if self.task_q is not None:
+            self.task_q.wake()
+        if self.runlet is not None:
+            green_thread_join(self.runlet)
 
 
+class TaskCancelled(Exception):
+    pass
+
 class TaskQueue:
-    def __init__(self, qsize):
-        self.task_q = GreenQueue(qsize)
+    """
+    items are taken by priority, 0 first, and in the order they were put
+    within one. items past their deadline are skipped by get and their
+    callers get DeadlineExceeded, cancelled ones are skipped as well.
+
+    a req_id given to put must be waited on, wait drops it from req_events
+    however it ends.
+    """
+    def __init__(self, qsize, priorities=1):
+        self.lanes = [deque() for _ in range(priorities)]
+        # free room and queued items, like a GreenQueue(qsize)
+        self.slots = Semaphore(qsize) if qsize else None
+        self.items = Semaphore(0)
+
         self.req_events = {}
+        # req ids of queued items, and of those cancelled while queued
+        self.queued = set()
+        self.cancelled = set()
+
+        self.metrics = Metrics()
+        self.metrics.add_gauge('task_depth', lambda: self.qsize())
+        self.metrics.add_gauge('task_waiters', lambda: len(self.req_events))
+        for priority, lane in enumerate(self.lanes):
+            self.metrics.add_gauge(f'task_depth_priority_{priority}', partial(len, lane))
+
+    def qsize(self):
+        return sum(len(lane) for lane in self.lanes)
 
-        for meth in ['empty', 'get']:
-            setattr(self, meth, getattr(self.task_q, meth))
+    def empty(self):
+        return not any(self.lanes)
 
-    def put(self, d, req_id=None):
+    def put(self, d, req_id=None, priority=0, deadline=None):
+        """
+        deadline: unix time after which the item is skipped, the deadline
+        of the rpc request being handled by default
+        """
         assert d
-        self.task_q.put((req_id, d))
+        if deadline is None:
+            deadline = get_deadline()
+        if self.slots is not None:
+            self.slots.acquire()
+
+        # registered first, the item may be done before put returns
         if req_id:
             self.req_events[req_id] = GreenEvent()
+            self.queued.add(req_id)
+        self.lanes[priority].append((req_id, d, deadline, priority, time.time()))
+        self.metrics.inc('tasks_total', {'priority': priority})
+        self.items.release()
+
+    def _pop(self):
+        for lane in self.lanes:
+            if lane:
+                entry = lane.popleft()
+                if entry is not None and self.slots is not None:
+                    self.slots.release()
+                return entry
+
+    def _take(self, entry):
+        # False for items to skip
+        req_id, d, deadline, priority, put_at = entry
+        self.queued.discard(req_id)
+        labels = {'priority': priority}
+        if req_id in self.cancelled:
+            self.cancelled.discard(req_id)
+            self.metrics.inc('tasks_cancelled_total', labels)
+            return False
+
+        if is_expired(deadline):
+            self.metrics.inc('tasks_expired_total', labels)
+            self.send(req_id, DeadlineExceeded(msg="task expired in queue"))
+            return False
+
+        self.metrics.observe('task_wait_seconds', time.time() - put_at, labels)
+        return True
+
+    def get(self, block=True, timeout=None):
+        """
+        returns (req_id, d), None after wake()
+        """
+        deadline = make_deadline(timeout)
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            if not self.items.acquire(blocking=block, timeout=remaining if block else None):
+                raise queue.Empty
+
+            entry = self._pop()
+            if entry is None:
+                return None
+            if self._take(entry):
+                return entry[:2]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def get_batch(self, max_items, timeout=0):
+        """
+        waits for an item, then takes more until there are max_items or
+        timeout seconds have passed. empty after wake()
+        """
+        items = [self.get()]
+        deadline = time.time() + timeout
+        while len(items) < max_items and items[-1] is not None:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    items.append(self.get(timeout=remaining))
+                else:
+                    items.append(self.get_nowait())
+            except queue.Empty:
+                break
+
+        return [i for i in items if i is not None]
+
+    def wake(self):
+        # unblocks get_batch
+        self.lanes[0].appendleft(None)
+        self.items.release()
+
+    def cancel(self, req_id):
+        """
+        the item is skipped if it is still queued, its caller gets
+        TaskCancelled
+        """
+        if req_id in self.queued:
+            self.cancelled.add(req_id)
+        self.send(req_id, TaskCancelled(req_id))
 
     def wait(self, req_id, timeout=None):
-        assert req_id in self.req_events
-        ret_val = self.req_events[req_id].get(timeout)
-        self.req_events.pop(req_id)
+        evt = self.req_events.get(req_id)
+        assert evt is not None
+        try:
+            ret_val = evt.get(timeout)
+        except BaseException:
+            # timed out or killed, nobody takes the result any more
+            if req_id in self.queued:
+                self.cancelled.add(req_id)
+            raise
+        finally:
+            self.req_events.pop(req_id, None)
+
+        if isinstance(ret_val, Exception):
+            raise ret_val
         return ret_val
 
-    def call(self, d):
+    def call(self, d, timeout=None, priority=0):
         req_id = str(uuid.uuid1())
-        self.put(d, req_id=req_id)
-        return self.wait(req_id)
+        deadline = make_deadline(timeout)
+        self.put(d, req_id=req_id, priority=priority, deadline=deadline)
+        if deadline is None:
+            # bounded by the rpc deadline the item got in put
+            timeout = remaining_time()
+        return self.wait(req_id, timeout)
 
     def send(self, req_id, data={}):
-        if req_id:
-            self.req_events[req_id].set(data)
+        # the caller may be gone already
+        evt = self.req_events.get(req_id) if req_id else None
+        if evt is not None and not evt.ready():
+            evt.set(data)
+
+    def get_stats(self):
+        return self.metrics.snapshot()
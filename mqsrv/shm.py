@@ -0,0 +1,148 @@
+import os
+import os.path as osp
+import re
+import mmap
+import time
+import socket
+import tempfile
+from loguru import logger
+from kombu import uuid
+from kombu.serialization import loads, prepare_accept_content
+
+from .contract import HOST_HEADER, ROUTING_KEY_HEADER, EXCLUSIVE_HEADER, SHM_HEADER, SHM_SIZE_HEADER
+from .rpc_utils import ACCEPT_CONTENT
+
+def get_host_id():
+    # containers usually get their own hostname and /dev/shm, so hostname plus
+    # boot id only matches for processes that can actually share a segment
+    boot_id = ''
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as fle:
+            boot_id = fle.read().strip()
+    except OSError:
+        pass
+    return f'{socket.gethostname()}/{boot_id}'
+
+HOST_ID = get_host_id()
+
+SHM_PREFIX = 'mqsrv-'
+_SHM_NAME_RE = re.compile(r'^mqsrv-[0-9a-f]{32}$')
+
+def get_shm_dir():
+    if osp.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+class ShmChannel:
+    """
+    moves serialized bodies above threshold into memory-mapped files under
+    shm_dir, only the segment name goes through the broker.
+
+    the receiver unlinks a segment as soon as it has mapped it, the writer
+    unlinks whatever is left after ttl seconds or on release, so segments of
+    requests or replies nobody read do not outlive their owner.
+    """
+    def __init__(self, threshold, shm_dir=None, ttl=300):
+        self.threshold = threshold
+        self.shm_dir = shm_dir or get_shm_dir()
+        self.ttl = ttl
+        self.accept = prepare_accept_content(ACCEPT_CONTENT)
+
+        self.segments = {}
+        self.local_routing_keys = set()
+
+    def get_path(self, name):
+        if not _SHM_NAME_RE.match(name):
+            raise ValueError(f"invalid shm segment name {name}")
+        return osp.join(self.shm_dir, name)
+
+    def dump(self, data):
+        name = SHM_PREFIX + uuid().replace('-', '')
+        path = self.get_path(name)
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+        try:
+            with os.fdopen(fd, 'wb') as fle:
+                fle.write(data)
+        except BaseException:
+            os.unlink(path)
+            raise
+
+        self.reap()
+        self.segments[path] = time.monotonic()
+        return name
+
+    def load(self, name, size):
+        path = self.get_path(name)
+        with open(path, 'rb') as fle:
+            buf = mmap.mmap(fle.fileno(), size, access=mmap.ACCESS_READ)
+        os.unlink(path)
+        return buf
+
+    def discard(self, name):
+        try:
+            os.unlink(self.get_path(name))
+        except (OSError, ValueError):
+            pass
+
+    def reap(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        expired = [k for k, v in self.segments.items() if now - v > self.ttl]
+        for path in expired:
+            self.segments.pop(path)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            logger.debug(f"reaped unread shm segment {path}")
+
+    def release(self):
+        self.reap(now=float('inf'))
+
+    def observe(self, message):
+        # replies tell which routing keys are served from this host. a
+        # shared queue may hand the next request to a server elsewhere, so
+        # only exclusive ones count
+        headers = message.headers or {}
+        routing_key = headers.get(ROUTING_KEY_HEADER)
+        if not routing_key:
+            return
+
+        if headers.get(HOST_HEADER) == HOST_ID and headers.get(EXCLUSIVE_HEADER):
+            self.local_routing_keys.add(routing_key)
+        else:
+            self.local_routing_keys.discard(routing_key)
+
+    def is_local(self, routing_key):
+        return routing_key in self.local_routing_keys
+
+    def put(self, data, headers):
+        headers[SHM_HEADER] = self.dump(data)
+        headers[SHM_SIZE_HEADER] = len(data)
+        return b''
+
+    def decode(self, message):
+        headers = message.headers or {}
+        name = headers.get(SHM_HEADER)
+        if not name:
+            return message.payload
+
+        buf = self.load(name, headers[SHM_SIZE_HEADER])
+        # binary codecs decode straight from the mapping, so msgpack-numpy
+        # arrays stay views over shared memory
+        if message.content_encoding == 'binary':
+            data = memoryview(buf)
+        else:
+            data = buf[:]
+        return loads(data, message.content_type, message.content_encoding, accept=self.accept)
+
+def decode_message(shm, message):
+    if shm is None:
+        return message.payload
+    return shm.decode(message)
+
+def discard_message(shm, message):
+    name = (message.headers or {}).get(SHM_HEADER)
+    if name and shm is not None:
+        shm.discard(name)
@@ -0,0 +1,118 @@
+"""
+event handlers by event type pattern. patterns are words separated by '.',
+like amqp topic bindings '*' stands for one word and '#' for zero or more,
+so 'user.*' matches 'user.created' and 'order.#' matches 'order' and
+'order.item.added'. patterns without wildcards are plain dict lookups.
+"""
+
+WORD_SEP = '.'
+
+def is_pattern(evt_type):
+    return isinstance(evt_type, str) and ('*' in evt_type or '#' in evt_type)
+
+class TrieNode:
+    __slots__ = ('children', 'handlers')
+
+    def __init__(self):
+        self.children = {}
+        # cb id -> handler of the patterns ending here
+        self.handlers = {}
+
+class TopicIndex:
+    """
+    handlers by cb id under their event type or pattern, with the reverse
+    index from cb id to pattern. matches of concrete event types are
+    cached until the next change of handlers.
+    """
+    def __init__(self, max_cached=10000):
+        self.exact = {}
+        self.root = TrieNode()
+        self.patterns = {}
+        self.n_wildcards = 0
+        self.max_cached = max_cached
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __contains__(self, cb_id):
+        return cb_id in self.patterns
+
+    def add(self, evt_type, cb_id, cb):
+        assert cb_id not in self.patterns
+        if is_pattern(evt_type):
+            node = self.root
+            for word in evt_type.split(WORD_SEP):
+                node = node.children.setdefault(word, TrieNode())
+            node.handlers[cb_id] = cb
+            self.n_wildcards += 1
+        else:
+            self.exact.setdefault(evt_type, {})[cb_id] = cb
+
+        self.patterns[cb_id] = evt_type
+        self.cache.clear()
+
+    def remove(self, cb_id):
+        """
+        returns the pattern cb_id was registered with, None if unknown
+        """
+        evt_type = self.patterns.pop(cb_id, None)
+        if evt_type is None:
+            return None
+
+        if is_pattern(evt_type):
+            self._remove_from_trie(self.root, evt_type.split(WORD_SEP), cb_id)
+            self.n_wildcards -= 1
+        else:
+            handlers = self.exact[evt_type]
+            handlers.pop(cb_id)
+            if not handlers:
+                self.exact.pop(evt_type)
+
+        self.cache.clear()
+        return evt_type
+
+    def _remove_from_trie(self, node, words, cb_id):
+        # prunes the branches left without handlers
+        if not words:
+            node.handlers.pop(cb_id, None)
+        else:
+            child = node.children.get(words[0])
+            if child is not None and self._remove_from_trie(child, words[1:], cb_id):
+                node.children.pop(words[0])
+        return not node.handlers and not node.children
+
+    def match(self, evt_type):
+        """
+        (pattern, handler) pairs of evt_type in the order they were
+        registered
+        """
+        if not self.n_wildcards or not isinstance(evt_type, str):
+            return [(evt_type, cb) for cb in self.exact.get(evt_type, {}).values()]
+
+        handlers = self.cache.get(evt_type)
+        if handlers is not None:
+            return handlers
+
+        found = dict(self.exact.get(evt_type, {}))
+        self._match(self.root, evt_type.split(WORD_SEP), 0, found)
+        handlers = [(self.patterns[cb_id], found[cb_id]) for cb_id in sorted(found)]
+
+        if len(self.cache) >= self.max_cached:
+            self.cache.clear()
+        self.cache[evt_type] = handlers
+        return handlers
+
+    def _match(self, node, words, i, found):
+        if i == len(words):
+            found.update(node.handlers)
+        else:
+            for key in (words[i], '*'):
+                child = node.children.get(key)
+                if child is not None:
+                    self._match(child, words, i + 1, found)
+
+        child = node.children.get('#')
+        if child is not None:
+            for j in range(i, len(words) + 1):
+                self._match(child, words, j, found)
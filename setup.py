@@ -14,6 +14,9 @@ setup(
         'loguru>=0.5',
         'gevent',
     ],
+    extras_require={
+        'aio': ['aio-pika>=9'],
+    },
     include_package_data=True,
     description='A message queue-based RPC and event publish/subscribe system.',
     long_description=open('README.md').read(),
@@ -0,0 +1,31 @@
+from mqsrv.server import make_server
+from mqsrv.client import make_client
+from greenthread.green import *
+from kombu import Connection
+
+def test_bad_partition_key():
+    conn = Connection('memory://', transport_options={'polling_interval': 0.005})
+    server = make_server(conn=conn, event_routing_keys=['lanes_queue'])
+    got = []
+    server.register_event_handler('order', lambda t, d: got.append(d), partition_key='key')
+    server.register_event_handler('order', lambda t, d: None, partition_key=lambda d: 1 / d['n'])
+    server.setup()
+    runlet = green_spawn(server.run)
+    green_sleep(0.3)
+
+    client = make_client(conn=conn.clone())
+    # an unhashable key and a failing key callable
+    client.publish('lanes_queue', 'order', {'key': [1, 2], 'n': 0})
+    client.publish('lanes_queue', 'order', {'key': 'a', 'n': 1})
+    for _ in range(100):
+        if len(got) == 2:
+            break
+        green_sleep(0.01)
+
+    assert [d['key'] for d in got] == [[1, 2], 'a']
+    assert not runlet.dead
+
+    server.should_stop = True
+    green_thread_join(runlet)
+    server.teardown()
+    client.release()